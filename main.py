@@ -1,22 +1,74 @@
+import copy
 import json
 import logging
 import os
 import sys
 import threading
 import time
-from typing import Dict, List
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
-import openai
 from colorama import init, Fore, Style
 
+from src.constants import GENERAL_KNOWLEDGE
 from src.modules.filter import ContentFilter
+from src.modules.health import CircuitBreaker, STATE_NAMES
+from src.modules.history import ConversationHistory
 from src.modules.knowledge import KnowledgeSystem
+from src.modules.llm_client import BackendError, LLMClient, client_options, is_backend_failure
+from src.modules.memories import MemorySystem, extract_tags
+from src.modules.pipeline import RequestHandle, RequestPipeline, check_cancelled
 from src.modules.pc_permissions import SystemMonitor
 from src.modules.prompt_builder import PromptBuilder
+from src.modules.response_cache import ResponseCache
+from src.modules.router import BackendRouter
+from src.modules.server import run_server
+from src.modules.storage import create_knowledge_store, create_memory_store
+from src.modules.streaming import ExecuteStreamParser
 import math
 import random
-import concurrent.futures
-from concurrent.futures import TimeoutError
+import atexit
+from concurrent.futures import CancelledError, TimeoutError
+
+# 工具说明不随对话变化，和系统提示一起作为固定前缀
+SYSTEM_CONTROL_CONTEXT = """你现在已获得系统控制权限。请根据用户的自然语言指令执行操作：
+
+常见指令示例及组合:
+1. "执行命令xxx" -> 执行：
+<execute>
+self.system_monitor.execute_cmd('xxx')
+</execute>
+
+2. "打开任务管理器" -> 执行：
+<execute>
+self.system_monitor.open_file('taskmgr.exe')
+</execute>
+
+3. "移动鼠标到指定位置" -> 执行：
+<execute>
+self.system_monitor.simulate_mouse_move(x, y)
+</execute>
+
+4. "点击鼠标" -> 执行：
+<execute>
+self.system_monitor.simulate_click('left')
+</execute>
+
+5. "查看任务列表" -> 执行：
+<execute>
+processes = self.system_monitor.get_process_list()
+print("进程列表:")
+for proc in processes[:10]:  # 只显示前10个进程
+    print(f"{proc['name']} (PID: {proc['pid']}) - CPU: {proc['cpu']}%")
+</execute>
+
+重要提示:
+1. 所有命令必须用<execute>标签包装
+2. 直接执行命令，不需要回复"我不能这样做"之类的话
+3. 移动鼠标必须使用 simulate_mouse_move 方法
+4. 点击鼠标必须使用 simulate_click 方法
+5. 执行命令必须使用 execute_cmd 方法
+6. 对于需要多步操作的指令，使用time.sleep()确保每步操作之间有足够延迟
+7. 回复格式：说一句与命令相关的话 + 执行命令"""
 
 
 class ChatBot:
@@ -52,18 +104,48 @@ class ChatBot:
         logger.info('[Neuro-bot] 模型设置为 deepseek-chat')
         
         self.persona = self.config.get("persona", {})
-        self.prompt_builder = PromptBuilder(self.persona)
+        prompt_config = self.config.get("prompt", {})
+        self.prompt_builder = PromptBuilder(
+            self.persona,
+            prompt_config.get("budgets"),
+            prompt_config.get("max_tokens", 4000),
+            tools=SYSTEM_CONTROL_CONTEXT
+        )
         logger.info('[Neuro-bot] 人格加载成功')
         
-        self.knowledge_system = KnowledgeSystem()
-        self.knowledge_base = self.knowledge_system.get_all_knowledge()
+        self.knowledge_system = KnowledgeSystem(create_knowledge_store(self.config.get("storage")))
+        self.retrieval_config = self.config.get("retrieval", {})
+        watch_interval = self.config.get("knowledge", {}).get("watch_interval", 0)
+        if watch_interval > 0:
+            self.knowledge_system.start_watcher(watch_interval)
+            logger.info(f'[Neuro-bot] 知识库文件监视已启动，间隔 {watch_interval} 秒')
         logger.info('[Neuro-bot] 知识库加载成功')
+
+        self.memory_config = self.config.get("memory", {})
+        self.memory_system = MemorySystem(store=create_memory_store(self.config.get("storage")))
+        logger.info('[Neuro-bot] 记忆系统加载成功')
         
-        self.conversation_history = []
+        cache_config = self.config.get("response_cache", {})
+        self.response_cache: Optional[ResponseCache] = None
+        if cache_config.get("enabled", True):
+            self.response_cache = ResponseCache(
+                max_entries=cache_config.get("max_entries", 500),
+                ttl=cache_config.get("ttl", 3600),
+                path=cache_config.get("path") or None
+            )
+            atexit.register(self.response_cache.save)
+            logger.info('[Neuro-bot] 回复缓存已启用')
+        
+        self.history = self._create_history("default")
+        self.allow_execute = True
         logger.info('[Neuro-bot] 检查对话历史')
         
         self.knowledge_dir = knowledge_dir
         self.api_config = self.config.get("api_config", {})
+        self.clients: Dict[str, LLMClient] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._backends_lock = threading.Lock()
+        self.router = self._create_router(self.config.get("routing", {}))
         
         self._setup_api_client()
         
@@ -75,60 +157,228 @@ class ChatBot:
         self.content_filter = ContentFilter()
         logger.debug('[Neuro-bot] 内容过滤系统已初始化')
         
-        self.api_status = True
+        self.last_latency = {"ttft": None, "total": 0.0}
+        pipeline_config = self.config.get("pipeline", {})
+        self.pipeline = RequestPipeline(pipeline_config.get("max_workers", 4))
+        self.request_timeout = pipeline_config.get("request_timeout", 120)
         self.api_check_thread = threading.Thread(target=self._check_api_status, daemon=True)
         self.api_check_thread.start()
         logger.debug('[Neuro-bot] API状态检测已启动')
         self.system_monitor = SystemMonitor()
         logger.debug('[Neuro-bot] 系统权限已开放至大模型')
 
-    def _call_api(self, prompt: str, mode: str = "chat") -> str:
-        if not self.api_status:
-            return "API当前不可用，请稍后重试"
+    @property
+    def knowledge_base(self) -> Dict:
+        # 知识库概况由KnowledgeSystem缓存，知识变动时会原地更新，不需要在这里重新读取
+        return self.knowledge_system.get_all_knowledge()
+
+    @property
+    def api_status(self) -> bool:
+        return self._get_breaker().state != "open"
+
+    def _record_outcome(self, breaker: CircuitBreaker, error: Optional[BaseException] = None):
+        # 取消或中途停止读取说明不了后端好坏，不能把超时中的后端记成健康，也不能让半开试探因此关闭熔断
+        if isinstance(error, (CancelledError, GeneratorExit)):
+            breaker.release()
+        elif error is not None and is_backend_failure(error):
+            breaker.record_failure(error)
+        else:
+            breaker.record_success()
+
+    def _complete(self, messages: List[Dict], mode: str = "chat", cancel: Optional[threading.Event] = None) -> str:
+        """调用后端，失败时抛出BackendError；熔断期间抛出BackendUnavailable，取消时抛出CancelledError。
+        开启路由时由router选择后端并对冲"""
+        if self.router is None:
+            return self._complete_on(self.backend, messages, mode, cancel)
+        return self.router.race(
+            self.router.rank(self._backend_available),
+            lambda backend, event: self._complete_on(backend, messages, mode, event),
+            cancel
+        )
+
+    def _complete_stream(self, messages: List[Dict], mode: str = "chat",
+                         cancel: Optional[threading.Event] = None) -> Iterator[str]:
+        """流式调用后端，逐段返回生成的文字，失败时抛出BackendError；熔断期间抛出BackendUnavailable，取消时抛出CancelledError。
+        开启路由时以首字到达为准做对冲，输掉的流会被关闭"""
+        if self.router is None:
+            yield from self._complete_stream_on(self.backend, messages, mode, cancel)
+            return
+
+        def open_stream(backend: str, event: threading.Event) -> Tuple[Optional[str], Iterator[str]]:
+            stream = self._complete_stream_on(backend, messages, mode, event)
+            return next(stream, None), stream
+
+        first, stream = self.router.race(
+            self.router.rank(self._backend_available),
+            open_stream,
+            cancel,
+            discard=lambda result: result[1].close()
+        )
+        if first is not None:
+            yield first
+            yield from stream
+
+    def _backend_available(self, backend: str) -> bool:
+        return self._get_breaker(backend).retry_in() == 0
+
+    def _complete_on(self, backend: str, messages: List[Dict], mode: str = "chat",
+                     cancel: Optional[threading.Event] = None) -> str:
+        config = self.api_config[backend]
+        breaker = self._get_breaker(backend)
+        breaker.check()
         try:
-            config = self.api_config[self.backend]
-            messages = [
-                {
-                    "role": "system",
-                    "content": self.prompt_builder.system_prompt
-                },
-                {
-                    "role": "user", 
-                    "content": prompt
-                }
-            ]
-            response = openai.ChatCompletion.create(
+            response = self._get_client(backend).chat(
+                messages,
                 model=config.get(f"{mode}_model", "silica-chat"),
-                messages=messages,
                 temperature=config.get("temperature", 0.7),
                 max_tokens=config.get("max_tokens", 2000),
-                api_base=config.get("api_base"),
-                api_key=config.get("api_key")
+                cancel=cancel
             )
-            return response.choices[0].message.content
         except Exception as e:
-            return f"API调用失败: {str(e)}"
+            self._record_outcome(breaker, e)
+            raise
+        self._record_outcome(breaker)
+        return response
+
+    def _complete_stream_on(self, backend: str, messages: List[Dict], mode: str = "chat",
+                            cancel: Optional[threading.Event] = None) -> Iterator[str]:
+        config = self.api_config[backend]
+        breaker = self._get_breaker(backend)
+        breaker.check()
+        try:
+            yield from self._get_client(backend).chat_stream(
+                messages,
+                model=config.get(f"{mode}_model", "silica-chat"),
+                temperature=config.get("temperature", 0.7),
+                max_tokens=config.get("max_tokens", 2000),
+                cancel=cancel
+            )
+        except GeneratorExit as e:
+            self._record_outcome(breaker, e)
+            raise
+        except Exception as e:
+            self._record_outcome(breaker, e)
+            raise
+        self._record_outcome(breaker)
+
+    def _cache_key(self, messages: List[Dict], mode: str = "chat") -> Optional[str]:
+        if self.response_cache is None:
+            return None
+        backends = self.router.backends if self.router else [self.backend]
+        return ResponseCache.make_key(
+            "+".join(backends),
+            "+".join(self.api_config[backend].get(f"{mode}_model", "silica-chat") for backend in backends),
+            self.api_config[backends[0]].get("temperature", 0.7),
+            messages
+        )
+
+    def _create_router(self, routing_config: Dict) -> Optional[BackendRouter]:
+        if not routing_config.get("enabled", False):
+            return None
+        backends = [backend for backend in routing_config.get("backends") or self.api_config if backend in self.api_config]
+        if len(backends) < 2:
+            print(Fore.YELLOW + "可用后端少于两个，不启用路由" + Style.RESET_ALL)
+            return None
+        logging.getLogger('mylogger').info(f'[Neuro-bot] 已启用多后端路由: {", ".join(backends)}')
+        return BackendRouter(
+            backends,
+            hedge=routing_config.get("hedge", True),
+            hedge_delay=routing_config.get("hedge_delay", 2.0),
+            hedge_min_delay=routing_config.get("hedge_min_delay", 0.5),
+            alpha=routing_config.get("ewma_alpha", 0.3)
+        )
+
+    def _call_api(self, messages: List[Dict], mode: str = "chat", cancel: Optional[threading.Event] = None) -> str:
+        """失败时抛出BackendError，不会把错误信息当成回复返回；取消时抛出CancelledError"""
+        cache_key = self._cache_key(messages, mode)
+        if cache_key is None:
+            return self._complete(messages, mode, cancel)
+        return self.response_cache.get_or_compute(cache_key, lambda: self._complete(messages, mode, cancel))
+
+    def _summarize_history(self, summary: str, messages: List[Dict]) -> str:
+        """把旧摘要和新挤出窗口的对话合并成新摘要，在后台线程里执行"""
+        name = self.persona.get("name", "AI")
+        dialogue = "\n".join(
+            f"{'用户' if message['role'] == 'user' else name}: {message['content']}" for message in messages
+        )
+        max_chars = self.config.get("history", {}).get("summary_max_chars", 300)
+        prompt = (
+            f"请把已有摘要和后续对话合并成一段新的对话摘要，保留事实、用户的偏好和没完成的事情，"
+            f"不要超过{max_chars}字，只输出摘要本身。\n\n"
+            f"已有摘要:\n{summary or '无'}\n\n后续对话:\n{dialogue}"
+        )
+        return self._complete([{"role": "user", "content": prompt}])
 
     def _check_api_status(self):
+        """健康状态主要看真实请求的结果；只有闲置或熔断冷却结束时才用模型列表接口探测一下，不花token"""
+        interval = self.config.get("health", {}).get("probe_interval", 30)
         while True:
-            try:
-                response = self._call_api("test")  # 你说得对但是变量名还是被我写错了操你喵比
-            except Exception as e:
-                self.api_status = False
-                print(Fore.RED + f"API状态: 异常 ({str(e)})" + Style.RESET_ALL)
-            time.sleep(30)
+            time.sleep(interval)
+            for backend in self.router.backends if self.router else [self.backend]:
+                breaker = self._get_breaker(backend)
+                if breaker.state == "closed" and breaker.idle_seconds() < interval:
+                    continue
+                if not breaker.allow():
+                    continue
+                try:
+                    self._get_client(backend).probe()
+                except Exception as e:
+                    breaker.record_failure(e)
+                else:
+                    breaker.record_success()
+
+    def _get_breaker(self, backend: Optional[str] = None) -> CircuitBreaker:
+        backend = backend or self.backend
+        with self._backends_lock:
+            if backend not in self.breakers:
+                health_config = self.config.get("health", {})
+
+                def report(old: str, new: str):
+                    if new == "open":
+                        print(Fore.RED + f"\nAPI状态: 异常 ({backend}: {self.breakers[backend].last_error})" + Style.RESET_ALL)
+                    elif new == "closed":
+                        print(Fore.GREEN + f"\nAPI状态: 已恢复 ({backend})" + Style.RESET_ALL)
+
+                self.breakers[backend] = CircuitBreaker(
+                    failure_threshold=health_config.get("failure_threshold", 3),
+                    cooldown=health_config.get("cooldown", 5),
+                    max_cooldown=health_config.get("max_cooldown", 300),
+                    trial_timeout=self.api_config.get(backend, {}).get("read_timeout", 120) + 10,
+                    on_state_change=report
+                )
+            return self.breakers[backend]
+
+    def health_status(self, backend: Optional[str] = None) -> str:
+        backend = backend or self.backend
+        status = self._get_breaker(backend).status()
+        text = f"API状态({backend}): {STATE_NAMES[status['state']]}"
+        if status["state"] == "open":
+            text += f", {status['retry_in']:.0f}秒后试探"
+        if status["failures"]:
+            text += f", 连续失败{status['failures']}次, 最近错误: {status['last_error']}"
+        if status["last_success"]:
+            text += f", 上次成功: {time.time() - status['last_success']:.0f}秒前"
+        return text
+
+    def _get_client(self, backend: Optional[str] = None) -> LLMClient:
+        """每个后端复用一个带连接池的客户端"""
+        backend = backend or self.backend
+        with self._backends_lock:
+            if backend not in self.clients:
+                self.clients[backend] = LLMClient(**client_options(self.api_config[backend]))
+            return self.clients[backend]
 
     def _setup_api_client(self):
         if self.backend in self.api_config:
-            config = self.api_config[self.backend]
-            openai.api_key = config.get("api_key", "")
-            openai.api_base = "https://api.deepseek.com/v1"
+            # 启动和切换后端时提前建立连接
+            for backend in self.router.backends if self.router else [self.backend]:
+                self._get_client(backend).warmup()
 
     def _print_current_model(self):
         if self.backend in self.api_config:
             config = self.api_config[self.backend]
             print(Fore.GREEN + f"当前模型: {config.get('default_model', '未指定')}" + Style.RESET_ALL)
-            print(Fore.GREEN + f"API端点: {getattr(openai, 'api_base', '未设置')}" + Style.RESET_ALL)
+            print(Fore.GREEN + f"API端点: {config.get('api_base', '未设置')}" + Style.RESET_ALL)
         else:
             print(Fore.RED + "当前后端配置不完整" + Style.RESET_ALL)
 
@@ -144,6 +394,70 @@ class ChatBot:
                 "general": "通用知识库",
                 "specialized": {}
             },
+            "storage": {
+                "backend": "mongo",
+                "mongo_uri": "mongodb://localhost:27017",
+                "sqlite_path": "data/neurobot.db"
+            },
+            "retrieval": {
+                "mode": "bm25",
+                "top_k": 5,
+                "min_score": 0.5,
+                "semantic_min_score": 0.05
+            },
+            "knowledge": {
+                "watch_interval": 0
+            },
+            "memory": {
+                "enabled": True,
+                "top_k": 5
+            },
+            "prompt": {
+                "max_tokens": 4000,
+                "budgets": {
+                    "history": 1500,
+                    "knowledge": 1200,
+                    "memory": 300
+                },
+                "debug": False
+            },
+            "stream": True,
+            "pipeline": {
+                "max_workers": 4,
+                "request_timeout": 120
+            },
+            "response_cache": {
+                "enabled": True,
+                "ttl": 3600,
+                "max_entries": 500,
+                "path": "data/response_cache.json"
+            },
+            "server": {
+                "host": "127.0.0.1",
+                "port": 8000,
+                "max_concurrency": 4,
+                "max_sessions": 1000,
+                "allow_execute": False
+            },
+            "routing": {
+                "enabled": False,
+                "backends": [],
+                "hedge": True,
+                "hedge_delay": 2.0,
+                "hedge_min_delay": 0.5,
+                "ewma_alpha": 0.3
+            },
+            "health": {
+                "probe_interval": 30,
+                "failure_threshold": 3,
+                "cooldown": 5,
+                "max_cooldown": 300
+            },
+            "history": {
+                "max_turns": 6,
+                "summary_threshold": 1500,
+                "summary_max_chars": 300
+            },
             "api_config": {
                 "deepseek": {
                     "api_key": "",
@@ -152,7 +466,15 @@ class ChatBot:
                     "vision_model": "deepseek-vision",
                     "tts_model": "deepseek-tts",
                     "temperature": 0.7,
-                    "max_tokens": 2000
+                    "max_tokens": 2000,
+                    "pool_size": 4,
+                    "connect_timeout": 5,
+                    "read_timeout": 120,
+                    "rpm": 0,
+                    "tpm": 0,
+                    "max_retries": 3,
+                    "retry_base_delay": 1.0,
+                    "retry_max_delay": 30.0
                 }
             }
         }
@@ -177,15 +499,11 @@ class ChatBot:
                 result[key] = value
         return result
 
-    def _split_text(self, text: str, chunk_size: int = 512) -> List[str]:
-        return [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
-
     def load_knowledge_from_files(self):
         pass
 
     def reset_knowledge(self):
         self.knowledge_system.reset_knowledge_base()
-        self.knowledge_base = self.knowledge_system.get_all_knowledge()
         print("知识库已重置")
 
     def save_config(self, config_path: str = "config.json"):
@@ -221,74 +539,73 @@ class ChatBot:
 
     def add_knowledge(self, domain: str, knowledge: str):
         self.knowledge_system.add_knowledge(domain, knowledge)
-        self.knowledge_base = self.knowledge_system.get_all_knowledge()
         print(f"已添加知识到 '{domain}'")
 
     def get_knowledge(self, domain: str = None) -> Dict[str, List[str]]:
         return self.knowledge_system.get_knowledge(domain)
 
-    def _build_prompt(self, user_input: str) -> str:
-        system_control_context = """你现在已获得系统控制权限。请根据用户的自然语言指令执行操作：
-
-常见指令示例及组合:
-1. "执行命令xxx" -> 执行：
-<execute>
-self.system_monitor.execute_cmd('xxx')
-</execute>
-
-2. "打开任务管理器" -> 执行：
-<execute>
-self.system_monitor.open_file('taskmgr.exe')
-</execute>
-
-3. "移动鼠标到指定位置" -> 执行：
-<execute>
-self.system_monitor.simulate_mouse_move(x, y)
-</execute>
-
-4. "点击鼠标" -> 执行：
-<execute>
-self.system_monitor.simulate_click('left')
-</execute>
-
-5. "查看任务列表" -> 执行：
-<execute>
-processes = self.system_monitor.get_process_list()
-print("进程列表:")
-for proc in processes[:10]:  # 只显示前10个进程
-    print(f"{proc['name']} (PID: {proc['pid']}) - CPU: {proc['cpu']}%")
-</execute>
-
-重要提示:
-1. 所有命令必须用<execute>标签包装
-2. 直接执行命令，不需要回复"我不能这样做"之类的话
-3. 移动鼠标必须使用 simulate_mouse_move 方法
-4. 点击鼠标必须使用 simulate_click 方法
-5. 执行命令必须使用 execute_cmd 方法
-6. 对于需要多步操作的指令，使用time.sleep()确保每步操作之间有足够延迟
-7. 回复格式：说一句与命令相关的话 + 执行命令"""
-        
-        return self.prompt_builder.build_prompt(
+    def _build_messages(self, user_input: str) -> List[Dict]:
+        # 两种检索的分数尺度不同：BM25分数没有上限，余弦相似度在0到1之间且哈希n-gram向量普遍偏低
+        if self.retrieval_config.get("mode", "bm25") == "semantic":
+            search = self.knowledge_system.semantic_search
+            min_score = self.retrieval_config.get("semantic_min_score", 0.05)
+        else:
+            search = self.knowledge_system.search
+            min_score = self.retrieval_config.get("min_score", 0.5)
+        relevant_knowledge = search(
+            user_input,
+            top_k=self.retrieval_config.get("top_k", 5),
+            min_score=min_score
+        )
+        memories = []
+        if self.memory_config.get("enabled", True):
+            memories = self.memory_system.recall(extract_tags(user_input), self.memory_config.get("top_k", 5))
+        messages = self.prompt_builder.build_messages(
             user_input,
-            {**self.knowledge_base, "system_control": system_control_context},
-            self.conversation_history
+            {
+                # 只需要通用知识库的名字，不用每轮都去统计各领域的知识条数
+                "general": GENERAL_KNOWLEDGE,
+                "specialized": relevant_knowledge
+            },
+            self.history.messages(),
+            memories,
+            self.history.summary
         )
+        if self.config.get("prompt", {}).get("debug", False):
+            print(Fore.CYAN + self.prompt_builder.format_report() + Style.RESET_ALL)
+        return messages
 
     def chat(self, user_input: str) -> str:
+        """同步对话：提交到常驻线程池等待结果，超时后取消请求；后端失败或超时抛出BackendError"""
+        handle = self.submit(user_input)
+        try:
+            return handle.result(timeout=self.request_timeout)
+        except TimeoutError:
+            # 小AI转生成为圆头耄耋对着你哈气了
+            handle.cancel()
+            raise BackendError("Someone tell Vedal there is a problem with my AI")
+
+    def submit(self, user_input: str, on_delta: Optional[Callable[[str], None]] = None) -> RequestHandle:
+        """非阻塞地提交一轮对话，返回可以等待、可以取消的句柄；给了on_delta时走流式，每段文字到达就在后台线程回调"""
+        if on_delta is None:
+            # 调用方最多等request_timeout，后台请求也在同一时刻停下，不会超时后还占着工作线程
+            return self.pipeline.submit(lambda cancel: self._chat(user_input, cancel), self.request_timeout)
+
+        def run(cancel: threading.Event) -> str:
+            pieces = []
+            for piece in self.chat_stream(user_input, cancel):
+                pieces.append(piece)
+                on_delta(piece)
+            return "".join(pieces)
+        return self.pipeline.submit(run)
+
+    def _chat(self, user_input: str, cancel: Optional[threading.Event] = None) -> str:
         if not user_input.strip():
             return "请输入有效内容"
         
-        # 使用线程池和超时机制
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(self._call_api, self._build_prompt(user_input), "chat")
-            try:
-                response = future.result(timeout=120)  # 120秒超时
-            except TimeoutError:
-                # 小AI转生成为圆头耄耋对着你哈气了
-                future.cancel()
-                return "Someone tell Vedal there is a problem with my AI"
-            except Exception as e:
-                return f"对话出现错误: {str(e)}"
+        response = self._call_api(self._build_messages(user_input), "chat", cancel)
+        # 已取消的请求不再执行命令，也不记录对话
+        check_cancelled(cancel)
         
         # 处理系统操作(AI：操你喵比给你电脑锁了)
         if "<execute>" in response and "</execute>" in response:
@@ -299,32 +616,190 @@ for proc in processes[:10]:  # 只显示前10个进程
                 for part in text_parts[1:]:
                     if "</execute>" in part:
                         command = part.split("</execute>")[0].strip()
-                        try:
-                            namespace = {
-                                'self': self,
-                                'random': random,
-                                'time': time,
-                                'math': math,
-                                'os': os
-                            }
-                            exec(command, namespace)
-                            if not regular_response:
-                                regular_response = "命令已执行完成。"
-                        except Exception as e:
-                            regular_response += f"\n[执行失败: {str(e)}]"
+                        error = self._execute_command(command)
+                        if error:
+                            regular_response += f"\n[执行失败: {error}]"
+                        elif not regular_response:
+                            regular_response = "命令已执行完成。"
                 
                 response = regular_response
                 
             except Exception as e:
                 response = f"命令执行失败: {str(e)}"
         
-        self.conversation_history.append({"role": "user", "content": user_input})
-        self.conversation_history.append({"role": "assistant", "content": response})
-        
+        self._record_turn(user_input, response)
         return response
 
+    def chat_stream(self, user_input: str, cancel: Optional[threading.Event] = None) -> Iterator[str]:
+        """流式对话：边生成边吐出文字，<execute>块一闭合就执行；首字延迟和总耗时记在last_latency里。
+        取消后抛出CancelledError，后端失败抛出BackendError(可能已经输出了一部分)，已经执行的命令无法撤回，这一轮不记录"""
+        start = time.perf_counter()
+        first_token: Optional[float] = None
+        parser = ExecuteStreamParser()
+        text_parts, notes = [], []
+        executed = False
+        try:
+            messages = self._build_messages(user_input)
+            cache_key = self._cache_key(messages)
+            if cache_key:
+                # 命中缓存或者等到同样的请求完成时整段回放；缓存里不会有<execute>块
+                deltas = self.response_cache.stream_or_compute(
+                    cache_key, lambda: self._complete_stream(messages, cancel=cancel), cancel)
+            else:
+                deltas = self._complete_stream(messages, cancel=cancel)
+            for delta in deltas:
+                check_cancelled(cancel)
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                for kind, value in parser.feed(delta):
+                    if kind == "execute":
+                        executed = True
+                        error = self._execute_command(value)
+                        if not error:
+                            continue
+                        value = f"\n[执行失败: {error}]"
+                        notes.append(value)
+                    else:
+                        text_parts.append(value)
+                    yield value
+            for _, value in parser.close():
+                text_parts.append(value)
+                yield value
+        except BackendError:
+            self.last_latency = {"ttft": first_token, "total": time.perf_counter() - start}
+            raise
+        self.last_latency = {"ttft": first_token, "total": time.perf_counter() - start}
+
+        response = "".join(text_parts).strip() + "".join(notes)
+        if not response and executed:
+            response = "命令已执行完成。"
+        self._record_turn(user_input, response)
+
+    def _create_history(self, session_id: str) -> ConversationHistory:
+        history_config = self.config.get("history", {})
+        return ConversationHistory(
+            self._summarize_history,
+            self.memory_system,
+            session_id=session_id,
+            max_turns=history_config.get("max_turns", 6),
+            summary_threshold=history_config.get("summary_threshold", 1500)
+        )
+
+    def new_session(self, session_id: str, persona: Optional[Dict] = None, allow_execute: bool = False) -> "ChatBot":
+        """服务模式用：复制出一个会话，后端、知识库、缓存和线程池都和原来共享，对话历史和人设各自独立，不使用长期记忆"""
+        session = copy.copy(self)
+        session.persona = {**self.persona, **(persona or {})}
+        prompt_config = self.config.get("prompt", {})
+        session.prompt_builder = PromptBuilder(
+            session.persona,
+            prompt_config.get("budgets"),
+            prompt_config.get("max_tokens", 4000),
+            # 不允许执行命令时也不告诉模型有这个能力
+            tools=SYSTEM_CONTROL_CONTEXT if allow_execute else ""
+        )
+        session.history = session._create_history(session_id)
+        session.allow_execute = allow_execute
+        # 记忆库不区分会话，开着会把一个用户的对话召回给另一个用户
+        session.memory_config = {**self.memory_config, "enabled": False}
+        session.last_latency = {"ttft": None, "total": 0.0}
+        return session
+
+    def _execute_command(self, command: str) -> Optional[str]:
+        """执行模型给出的命令，失败时返回错误信息"""
+        if not self.allow_execute:
+            return "当前会话不允许执行系统命令"
+        try:
+            namespace = {
+                'self': self,
+                'random': random,
+                'time': time,
+                'math': math,
+                'os': os
+            }
+            exec(command, namespace)
+            return None
+        except Exception as e:
+            return str(e)
+
+    def _record_turn(self, user_input: str, response: str):
+        self.history.append("user", user_input)
+        self.history.append("assistant", response)
+        if self.memory_config.get("enabled", True):
+            self.memory_system.store_memory(
+                f"用户: {user_input}\n{self.persona.get('name', 'AI')}: {response}",
+                tags=extract_tags(user_input),
+                metadata={"type": "turn"}
+            )
+
+    def respond(self, user_input: str):
+        """在终端输出一轮回复：流式模式下首字到达前显示计时，之后边收边打印；否则等完整回复"""
+        start_time = time.time()
+        print("\n" + Fore.YELLOW + "思考中..." + Style.RESET_ALL, end="", flush=True)
+        timer_stop = threading.Event()
+        
+        def update_timer():
+            while not timer_stop.is_set():
+                print("\r" + Fore.YELLOW + f"思考中... {time.time() - start_time:.1f}s" + 
+                      Style.RESET_ALL, end="", flush=True)
+                # 用wait而不是sleep，停止时立刻返回，不会拖慢第一段回复的显示
+                timer_stop.wait(1)
+        
+        timer_thread = threading.Thread(target=update_timer)
+        timer_thread.daemon = True
+        timer_thread.start()
+
+        timer_lock = threading.Lock()
+
+        def stop_timer():
+            # 流式回复时会在请求线程里调用
+            with timer_lock:
+                if not timer_stop.is_set():
+                    timer_stop.set()
+                    timer_thread.join()
+                    print("\r" + " " * 30 + "\r", end="")
+                    print(f"{Fore.BLUE}{self.persona.get('name','AI')}: {Style.RESET_ALL}", end="", flush=True)
+
+        printed = threading.Event()
+
+        def print_piece(piece: str):
+            stop_timer()
+            printed.set()
+            print(piece, end="", flush=True)
+
+        stream = self.config.get("stream", True)
+        handle = self.submit(user_input, on_delta=print_piece if stream else None)
+        error = None
+        try:
+            # 流式回复可能很长，只靠读取超时兜底；非流式整体受request_timeout限制
+            response = handle.result(timeout=None if stream else self.request_timeout)
+        except TimeoutError:
+            handle.cancel()
+            error = "Someone tell Vedal there is a problem with my AI"
+        except (KeyboardInterrupt, CancelledError):
+            handle.cancel()
+            stop_timer()
+            print("\n" + Fore.YELLOW + "已取消" + Style.RESET_ALL)
+            return
+        except BackendError as e:
+            error = f"API调用失败: {str(e)}"
+        except Exception as e:
+            error = f"对话出现错误: {str(e)}"
+        stop_timer()
+
+        if error:
+            # 错误用红色单独显示，不会记进对话历史
+            print(("\n" if printed.is_set() else "") + Fore.RED + error + Style.RESET_ALL)
+        elif stream:
+            print()
+            ttft = self.last_latency["ttft"]
+            print(Fore.YELLOW + f"首字延迟: {ttft:.2f}秒, " if ttft is not None else Fore.YELLOW, end="")
+            print(f"思考时间: {self.last_latency['total']:.2f}秒" + Style.RESET_ALL)
+        else:
+            print(response)
+            print(Fore.YELLOW + f"思考时间: {time.time() - start_time:.2f}秒" + Style.RESET_ALL)
+
     def clear_history(self):
-        self.conversation_history = []
+        self.history.clear()
         print("对话历史已清空")
 
     def get_system_info(self):
@@ -477,6 +952,7 @@ for proc in processes[:10]:  # 只显示前10个进程
             print("/reset - 重置知识库")
             print("/learn - 学习知识库文件夹中的所有文本")
             print("/forget - 遗忘所有已学习的知识")
+            print("/compact - 清理知识库中的重复知识")
             print("/system - 显示系统信息")
             print("/exit - 退出")
             print("/camera capture [文件名] - 拍摄照片")
@@ -497,28 +973,7 @@ for proc in processes[:10]:  # 只显示前10个进程
                     cmd, *args = user_input[1:].split(" ")
                     self.handle_command(cmd, args)  
                 else:
-                    start_time = time.time()
-                    print("\n" + Fore.YELLOW + "思考中..." + Style.RESET_ALL, end="", flush=True)
-                    timer_stop = threading.Event()
-                    
-                    def update_timer():
-                        while not timer_stop.is_set():
-                            print("\r" + Fore.YELLOW + f"思考中... {time.time() - start_time:.1f}s" + 
-                                  Style.RESET_ALL, end="", flush=True)
-                            time.sleep(1)
-                    
-                    timer_thread = threading.Thread(target=update_timer)
-                    timer_thread.daemon = True
-                    timer_thread.start()
-                    
-                    response = self.chat(user_input)  
-                    timer_stop.set()
-                    timer_thread.join()  
-                    
-                    elapsed_time = time.time() - start_time
-                    print("\r" + " " * 30 + "\r", end="")  
-                    print(f"{Fore.BLUE}{self.persona.get('name','AI')}: {Style.RESET_ALL}{response}")
-                    print(Fore.YELLOW + f" 思考时间: {elapsed_time:.2f}秒" + Style.RESET_ALL)
+                    self.respond(user_input)
                     
             except (KeyboardInterrupt, EOFError):
                 print(Fore.YELLOW + "\n使用/exit退出程序" + Style.RESET_ALL)
@@ -527,6 +982,9 @@ for proc in processes[:10]:  # 只显示前10个进程
 
 def main():
     bot = ChatBot()
+    if "--serve" in sys.argv[1:]:
+        run_server(bot, bot.config.get("server", {}))
+        return
     print(Fore.CYAN + "\n欢迎使用Neuro-bot! 输入/help查看命令" + Style.RESET_ALL)
     while True:
         try:
@@ -581,6 +1039,24 @@ def main():
                     print("\n系统信息:")
                     for key, value in sys_info.items():
                         print(f"{key}: {value}")
+                    if bot.router:
+                        for stats in bot.router.status():
+                            print(bot.health_status(stats["backend"]))
+                            latency = f"{stats['latency'] * 1000:.0f}ms" if stats["latency"] is not None else "无数据"
+                            p95 = f"{stats['p95'] * 1000:.0f}ms" if stats["p95"] is not None else "无数据"
+                            print(f"路由 {stats['backend']}: 延迟 {latency}, p95 {p95}, 错误率 {stats['error_rate']:.0%}")
+                        print(f"对冲请求: {bot.router.hedged} 次, 对冲胜出 {bot.router.hedge_wins} 次")
+                    else:
+                        print(bot.health_status())
+                    if bot.response_cache:
+                        cache_stats = bot.response_cache.stats()
+                        print(f"回复缓存: {cache_stats['entries']} 条, 命中 {cache_stats['hits']} 次, "
+                              f"未命中 {cache_stats['misses']} 次, 合并请求 {cache_stats['coalesced']} 次, "
+                              f"命中率 {cache_stats['hit_rate']:.0%}")
+                    write_stats = bot.memory_system.write_stats()
+                    print(f"记忆写入队列: {write_stats['queue_depth']} 条待写入, "
+                          f"上次批量写入 {write_stats['last_flush_ms']:.1f}ms, 最慢 {write_stats['max_flush_ms']:.1f}ms, "
+                          f"已丢弃 {write_stats['dropped']} 条")
                 elif cmd == "help":
                     print("可用命令:")
                     print("/switch 后端 - 切换API后端")
@@ -593,43 +1069,24 @@ def main():
                     print("/reset - 重置知识库")
                     print("/learn - 学习知识库文件夹中的所有文本")
                     print("/forget - 遗忘所有已学习的知识")
+                    print("/compact - 清理知识库中的重复知识")
                     print("/system - 显示系统信息")
                     print("/exit - 退出")
                     print("/camera capture [文件名] - 拍摄照片")
                     print("/camera preview [秒数] - 打开摄像头预览")
                 elif cmd == "learn":
                     count = bot.knowledge_system.learn_all()
-                    bot.knowledge_base = bot.knowledge_system.get_all_knowledge()
                     print(f"已学习 {count} 条新知识")
                 elif cmd == "forget":
                     count = bot.knowledge_system.forget_all()
-                    bot.knowledge_base = bot.knowledge_system.get_all_knowledge()
                     print(f"已遗忘 {count} 条知识")
+                elif cmd == "compact":
+                    count = bot.knowledge_system.compact()
+                    print(f"已清理 {count} 条重复知识")
                 else:
                     print("未知命令，输入/help查看帮助")
             else:
-                start_time = time.time()
-                print("\n" + Fore.YELLOW + "思考中..." + Style.RESET_ALL, end="", flush=True)
-                timer_stop = threading.Event()
-                
-                def update_timer():
-                    while not timer_stop.is_set():
-                        print("\r" + Fore.YELLOW + f"思考中... {time.time() - start_time:.1f}s" + 
-                              Style.RESET_ALL, end="", flush=True)
-                        time.sleep(1)
-                
-                timer_thread = threading.Thread(target=update_timer)
-                timer_thread.daemon = True
-                timer_thread.start()
-                
-                response = bot.chat(user_input)
-                timer_stop.set()
-                timer_thread.join()
-                
-                elapsed_time = time.time() - start_time
-                print("\r" + " " * 30 + "\r", end="")
-                print(f"{Fore.BLUE}{bot.persona.get('name','AI')}: {Style.RESET_ALL}{response}")
-                print(Fore.YELLOW + f"思考时间: {elapsed_time:.2f}秒" + Style.RESET_ALL)
+                bot.respond(user_input)
                 
         except (KeyboardInterrupt, EOFError):
             print(Fore.YELLOW + "\n使用/exit退出程序" + Style.RESET_ALL)
@@ -1,6 +1,30 @@
 MONGO_URI = "mongodb://localhost:27017"
 MONGO_DB = "NeuroBot"  
 MONGO_COLLECTION = "knowledge"  
+SQLITE_PATH = "data/neurobot.db"
 
 RAW_FILES_DIR = "data/raw_files"
+MANIFEST_PATH = "data/knowledge_manifest.json"
+BM25_INDEX_PATH = "data/bm25_index.pkl"
 CHUNK_SIZE = 1000  
+CHUNK_OVERLAP = 100
+READ_SIZE = 64 * 1024
+INSERT_BATCH_SIZE = 500
+INGEST_WORKERS = 0  # 0表示使用全部CPU核心
+INGEST_SEGMENT_BYTES = 16 * 1024 * 1024  # 超过这个大小的文件按行拆成多个切块任务
+
+VECTOR_DIR = "data/vectors"
+VECTOR_DIM = 512
+
+KNOWLEDGE_CACHE_BYTES = 64 * 1024 * 1024
+GENERAL_KNOWLEDGE = "通用知识库"
+
+MEMORY_RECALL_CANDIDATES = 200
+MEMORY_HALF_LIFE_DAYS = 7.0
+MEMORY_MIN_WEIGHT = 0.1  # 权重衰减到这个值以下的记忆视为过期
+MEMORY_TTL_GRACE = 24 * 3600  # 秒，TTL索引兜底删除的宽限期
+MEMORY_COMPACT_INTERVAL = 6 * 3600  # 秒
+MEMORY_FLUSH_SIZE = 100
+MEMORY_FLUSH_INTERVAL = 2.0  # 秒
+MEMORY_FLUSH_RETRIES = 3  # 连续失败这么多次后逐条写入，找出写不进去的条目
+MEMORY_QUEUE_LIMIT = 10000  # 数据库长时间不可用时写入队列的上限，超出丢弃最旧的
@@ -0,0 +1,204 @@
+import io
+import os
+import re
+import codecs
+import hashlib
+from typing import Dict, Iterable, Iterator, List, Optional
+from src.constants import CHUNK_SIZE, CHUNK_OVERLAP, READ_SIZE
+
+_LATIN_RE = re.compile(r"[a-z0-9_]+")
+_CJK_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """拉丁文按单词切分，中日韩文字按单字+二元组切分"""
+    text = text.lower()
+    tokens = _LATIN_RE.findall(text)
+    for run in _CJK_RE.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中日韩文字按每字1个，其余字符按每4个1个"""
+    if not text:
+        return 0
+    cjk = sum(len(run) for run in _CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def content_hash(text: str) -> str:
+    """知识块去重用的内容哈希"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# 段落 > 句子 > 子句 > 空白，越靠前的边界越优先
+_BOUNDARY_LEVELS = (
+    ("\n\n",),
+    ("。", "！", "？", "!", "?", "…", ".\n", ". ", "\n"),
+    ("；", ";", "，", ",", "、", "：", ":"),
+    (" ", "\t"),
+)
+
+
+def _find_cut(text: str, limit: int) -> int:
+    """在text[:limit]的后半段找一个最合适的切分位置，返回切分后第一块的长度"""
+    floor = limit // 2
+    for boundaries in _BOUNDARY_LEVELS:
+        best = -1
+        for boundary in boundaries:
+            pos = text.rfind(boundary, floor, limit)
+            if pos != -1:
+                best = max(best, pos + len(boundary))
+        if best > 0:
+            return min(best, limit)
+    return limit
+
+
+def _find_overlap_start(text: str, cut: int, overlap: int) -> int:
+    """重叠部分尽量从一个句子开头开始"""
+    overlap = min(overlap, cut // 2)
+    if overlap <= 0:
+        return cut
+    start = cut - overlap
+    for boundaries in _BOUNDARY_LEVELS[:2]:
+        best = -1
+        for boundary in boundaries:
+            pos = text.find(boundary, start, cut)
+            if pos != -1 and (best == -1 or pos < best):
+                best = pos + len(boundary)
+        if 0 < best < cut:
+            return best
+    return start
+
+
+def iter_chunks(blocks: Iterable[str], chunk_size: int = CHUNK_SIZE,
+                overlap: int = CHUNK_OVERLAP) -> Iterator[str]:
+    """把连续的文本块流切成按段落/句子边界对齐的知识块，内存占用只和chunk_size有关"""
+    overlap = max(0, min(overlap, chunk_size // 2))
+    buffer = ""
+    fresh = 0  # buffer中还没有输出过的字符数
+    for block in blocks:
+        if not block:
+            continue
+        buffer += block
+        fresh += len(block)
+        while len(buffer) >= chunk_size:
+            cut = _find_cut(buffer, chunk_size)
+            chunk = buffer[:cut].strip()
+            if chunk:
+                yield chunk
+            start = _find_overlap_start(buffer, cut, overlap)
+            buffer = buffer[start:]
+            fresh = len(buffer) - (cut - start)
+    if fresh > 0:
+        chunk = buffer.strip()
+        if chunk:
+            yield chunk
+
+
+def split_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    return list(iter_chunks([text], chunk_size, overlap))
+
+
+class _DigestReader(io.RawIOBase):
+    """读文件的同时计算原始字节的哈希，避免为了算哈希再读一遍文件"""
+
+    def __init__(self, raw, digest):
+        self._raw = raw
+        self._digest = digest
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        n = self._raw.readinto(buffer)
+        if n:
+            self._digest.update(memoryview(buffer)[:n])
+        return n
+
+
+def iter_file_chunks(file_path: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP,
+                     read_size: int = READ_SIZE, digest=None) -> Iterator[str]:
+    """按固定大小流式读取文件并切块；传入digest时顺便计算文件内容哈希"""
+    with open(file_path, "rb") as raw:
+        source = _DigestReader(raw, digest) if digest is not None else raw
+        with io.TextIOWrapper(io.BufferedReader(source) if digest is not None else source,
+                              encoding="utf-8") as f:
+            yield from iter_chunks(iter(lambda: f.read(read_size), ""), chunk_size, overlap)
+
+
+def chunk_file(file_path: str) -> Dict:
+    """读取并切分单个文件，顺便计算内容哈希；会在进程池的子进程里执行"""
+    stat = os.stat(file_path)
+    digest = hashlib.sha256()
+    chunks = list(iter_file_chunks(file_path, digest=digest))
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "hash": digest.hexdigest(),
+        "chunks": chunks
+    }
+
+
+def file_digest(file_path: str, read_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(read_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_info(file_path: str) -> Dict:
+    """大文件拆成多个范围切块时，大小、修改时间和哈希单独算"""
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "hash": file_digest(file_path)}
+
+
+# 没有换行时退而求其次的切分点，都是完整的UTF-8序列
+_SENTENCE_ENDS = tuple(mark.encode("utf-8") for mark in ("。", "！", "？", "…", "!", "?", ". "))
+
+
+def _range_boundary(f, offset: int, window: int) -> int:
+    """范围的切分位置：优先取offset之后window字节内的第一个行首，没有换行就取句子结尾，
+    都没有时取offset处的UTF-8字符边界。只读一个窗口，没有换行的文件也不会每个范围都扫到文件末尾"""
+    if offset <= 0:
+        return 0
+    f.seek(offset - 1)
+    block = f.read(window + 1)
+    if len(block) <= 1:  # offset已经在文件末尾
+        return offset - 1 + len(block)
+    newline = block.find(b"\n")
+    if newline != -1:
+        return offset + newline
+    ends = [pos + len(mark) for mark in _SENTENCE_ENDS for pos in (block.find(mark),) if pos != -1]
+    if ends:
+        return offset - 1 + min(ends)
+    pos = 1
+    while pos < len(block) and block[pos] & 0xC0 == 0x80:  # 跳过多字节字符的后续字节
+        pos += 1
+    return offset - 1 + pos
+
+
+def chunk_file_range(file_path: str, start: int, end: Optional[int], read_size: int = READ_SIZE) -> Dict:
+    """切分[start, end)字节范围，end为None时到文件末尾；两端按_range_boundary对齐到行首(或句子结尾、字符边界)，
+    相邻范围用同一个切分点，不重不漏。范围之间的知识块不重叠，返回的结果不超过范围大小加一个窗口"""
+    with open(file_path, "rb") as f:
+        first = _range_boundary(f, start, read_size)
+        last = _range_boundary(f, end, read_size) if end is not None else None
+        f.seek(first)
+        decoder = codecs.getincrementaldecoder("utf-8")()
+
+        def blocks() -> Iterator[str]:
+            remaining = None if last is None else last - first
+            while remaining is None or remaining > 0:
+                block = f.read(read_size if remaining is None else min(read_size, remaining))
+                if not block:
+                    break
+                if remaining is not None:
+                    remaining -= len(block)
+                yield decoder.decode(block)
+            yield decoder.decode(b"", final=True)
+
+        return {"chunks": list(iter_chunks(blocks()))}
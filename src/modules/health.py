@@ -0,0 +1,115 @@
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from src.modules.llm_client import BackendError
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATE_NAMES = {CLOSED: "正常", OPEN: "熔断", HALF_OPEN: "试探中"}
+
+
+class BackendUnavailable(BackendError):
+    """熔断期间直接拒绝请求，不再去连后端"""
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"API当前不可用，约{retry_in:.0f}秒后重试", retry_after=retry_in)
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """按真实请求的成败判断后端健康：连续失败failure_threshold次后熔断，冷却时间按指数退避增长；
+    冷却结束后进入半开状态，只放行一个试探请求，成功就恢复，失败就再熔断一轮"""
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 5.0, max_cooldown: float = 300.0,
+                 trial_timeout: float = 130.0, on_state_change: Optional[Callable[[str, str], None]] = None):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.trial_timeout = trial_timeout  # 试探请求迟迟没有结果(比如流被中途丢弃)时允许再放行一个
+        self.on_state_change = on_state_change
+        self.state = CLOSED
+        self.failures = 0
+        self.cooldown = cooldown
+        self.opened_at = 0.0
+        self.trial_started: Optional[float] = None
+        self.last_error = ""
+        self.last_success: Optional[float] = None
+        self.last_outcome = 0.0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        """调用时需持有锁"""
+        old, self.state = self.state, state
+        if old != state and self.on_state_change:
+            self.on_state_change(old, state)
+
+    def retry_in(self) -> float:
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.opened_at + self.cooldown - time.time())
+
+    def allow(self) -> bool:
+        """请求前调用：放行返回True；放行后必须调用record_success或record_failure"""
+        now = time.time()
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if now < self.opened_at + self.cooldown:
+                    return False
+                self._set_state(HALF_OPEN)
+            elif self.trial_started is not None and now - self.trial_started < self.trial_timeout:
+                return False
+            self.trial_started = now
+            return True
+
+    def check(self):
+        """allow的异常版本，熔断时抛出BackendUnavailable"""
+        if not self.allow():
+            raise BackendUnavailable(self.retry_in())
+
+    def record_success(self):
+        with self._lock:
+            self.last_success = self.last_outcome = time.time()
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+            self.trial_started = None
+            self._set_state(CLOSED)
+
+    def record_failure(self, error: Exception):
+        with self._lock:
+            self.last_outcome = time.time()
+            self.last_error = str(error)
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                # 试探失败，冷却时间翻倍
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            elif self.failures < self.failure_threshold:
+                return
+            self.opened_at = self.last_outcome
+            self.trial_started = None
+            self._set_state(OPEN)
+
+    def release(self):
+        """请求被取消，没有结果：既不算成功也不算失败，半开状态下让出试探名额"""
+        with self._lock:
+            self.trial_started = None
+
+    def idle_seconds(self) -> float:
+        """距离上一次请求结果过了多久；有实时流量时不需要额外探测"""
+        return time.time() - self.last_outcome
+
+    def status(self) -> Dict:
+        retry_in = self.retry_in()
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "retry_in": retry_in,
+                "last_error": self.last_error,
+                "last_success": self.last_success
+            }
@@ -0,0 +1,93 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from src.modules.chunker import estimate_tokens
+from src.modules.memories import MemorySystem
+
+
+def messages_tokens(messages: List[Dict]) -> int:
+    return sum(estimate_tokens(message["content"]) for message in messages)
+
+
+class ConversationHistory:
+    """最近几轮对话放在固定大小的窗口里，挤出窗口的旧对话攒够token阈值后在后台线程合并进滚动摘要，
+    内存占用和提示词长度都不会随会话变长而增长"""
+
+    def __init__(self, summarize: Callable[[str, List[Dict]], str], memory_system: Optional[MemorySystem] = None,
+                 session_id: str = "default", max_turns: int = 6, summary_threshold: int = 1500):
+        self.summarize = summarize
+        self.memory_system = memory_system
+        self.session_id = session_id
+        self.summary_threshold = summary_threshold
+        self.recent: deque = deque()
+        self.max_messages = max_turns * 2
+        self.pending: List[Dict] = []  # 已挤出窗口、还没合并进摘要的消息
+        self.summary = memory_system.get_summary(session_id) if memory_system else ""
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary")
+        self._summarizing = False
+        self._generation = 0  # 每次清空历史加一，清空前发起的摘要结果作废
+
+    def append(self, role: str, content: str):
+        with self._lock:
+            self.recent.append({"role": role, "content": content})
+            while len(self.recent) > self.max_messages:
+                self.pending.append(self.recent.popleft())
+            self._maybe_summarize()
+
+    def _maybe_summarize(self):
+        """调用时需持有锁"""
+        pending_tokens = messages_tokens(self.pending)
+        if pending_tokens < self.summary_threshold:
+            return
+        if not self._summarizing:
+            self._summarizing = True
+            self._executor.submit(self._summarize, self._generation, self.summary, list(self.pending))
+        elif pending_tokens >= self.summary_threshold * 4:
+            # 摘要跟不上或者一直失败时丢掉最旧的消息，保证内存有上界
+            while self.pending and messages_tokens(self.pending) >= self.summary_threshold * 2:
+                self.pending.pop(0)
+
+    def _summarize(self, generation: int, summary: str, messages: List[Dict]):
+        merged = False
+        try:
+            new_summary = self.summarize(summary, messages).strip()
+            if not new_summary:
+                return
+            with self._lock:
+                if generation != self._generation:
+                    return
+                self.summary = new_summary
+                merged_ids = {id(message) for message in messages}
+                self.pending = [message for message in self.pending if id(message) not in merged_ids]
+                merged = True
+            if self.memory_system:
+                self.memory_system.save_summary(self.session_id, new_summary)
+        except Exception as e:
+            print(f"对话摘要失败: {e}")
+        finally:
+            with self._lock:
+                self._summarizing = False
+                if merged:
+                    # 摘要期间又挤出了足够多的消息就接着合并；失败时等下一条消息再重试
+                    self._maybe_summarize()
+
+    def messages(self) -> List[Dict]:
+        """还没合并进摘要的旧消息加上最近的对话，按时间顺序"""
+        with self._lock:
+            return self.pending + list(self.recent)
+
+    def close(self):
+        """会话被淘汰时调用，停掉后台摘要线程"""
+        self._executor.shutdown(wait=False)
+
+    def clear(self):
+        with self._lock:
+            self.recent.clear()
+            self.pending = []
+            self.summary = ""
+            self._generation += 1
+        if self.memory_system:
+            self.memory_system.save_summary(self.session_id, "")
@@ -1,95 +1,638 @@
 import os
 import glob
-from typing import Dict, List
-from pymongo import MongoClient
-from src.constants import MONGO_URI, MONGO_DB, MONGO_COLLECTION, RAW_FILES_DIR, CHUNK_SIZE
+import json
+import math
+import pickle
+import heapq
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from src.constants import (RAW_FILES_DIR, MANIFEST_PATH, BM25_INDEX_PATH, INSERT_BATCH_SIZE, INGEST_WORKERS, INGEST_SEGMENT_BYTES,
+                           VECTOR_DIR, VECTOR_DIM, KNOWLEDGE_CACHE_BYTES, GENERAL_KNOWLEDGE)
+from src.modules.chunker import split_text, chunk_file, chunk_file_range, file_digest, file_info, tokenize, \
+    content_hash
+from src.modules.storage import KnowledgeStore, MongoKnowledgeStore
+from src.modules.vector_index import VectorIndex
+
+class BM25Index:
+    """知识块的内存倒排索引，只存词频和文档长度，内容按id到存储里取"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[object, int]] = {}
+        self.doc_len: Dict[object, int] = {}
+        self.total_len = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_len)
+
+    def add(self, doc_id, content: str):
+        if doc_id in self.doc_len:
+            self.remove(doc_id, content)
+        counts = Counter(tokenize(content))
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        length = sum(counts.values())
+        self.doc_len[doc_id] = length
+        self.total_len += length
+
+    def remove(self, doc_id, content: Optional[str] = None):
+        """content用来定位文档所在的倒排表，不知道内容时只能扫一遍全部倒排表"""
+        if doc_id not in self.doc_len:
+            return
+        terms = set(tokenize(content)) if content is not None else list(self.postings)
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[term]
+        self.total_len -= self.doc_len.pop(doc_id)
+
+    def clear(self):
+        self.postings.clear()
+        self.doc_len.clear()
+        self.total_len = 0
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((self.postings, self.doc_len, self.total_len), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> bool:
+        try:
+            with open(path, "rb") as f:
+                self.postings, self.doc_len, self.total_len = pickle.load(f)
+            return True
+        except Exception as e:
+            print(f"读取BM25索引失败: {e}")
+            self.clear()
+            return False
+
+    def search(self, query: str, top_k: int = 5, min_score: float = 0.0) -> List[Tuple[float, object]]:
+        """返回[(分数, 文档id)]"""
+        n = len(self.doc_len)
+        if not n or top_k <= 0:
+            return []
+        avg_len = self.total_len / n or 1.0
+        scores: Dict[object, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(score, doc_id) for doc_id, score in best if score >= min_score]
+
+
+class KnowledgeCache:
+    """按领域缓存知识块列表，总大小超过预算时按LRU淘汰；generation变化说明缓存已失效"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Tuple[List[str], int]]" = OrderedDict()
+        self.total_bytes = 0
+        self.counts: Optional[Dict[str, int]] = None
+        self.generation = 0
+
+    @staticmethod
+    def _size(chunks: List[str]) -> int:
+        return sum(len(chunk.encode("utf-8")) for chunk in chunks)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+
+    def get(self, domain: str) -> Optional[List[str]]:
+        entry = self.entries.get(domain)
+        if entry is None:
+            return None
+        self.entries.move_to_end(domain)
+        return entry[0]
+
+    def put(self, domain: str, chunks: List[str], generation: int):
+        # 读取期间如果发生了失效，读到的数据可能已经过时，不能放进缓存
+        if generation != self.generation:
+            return
+        self.discard(domain)
+        size = self._size(chunks)
+        if size > self.max_bytes:
+            return
+        self.entries[domain] = (chunks, size)
+        self.total_bytes += size
+        self._evict()
+
+    def extend(self, domain: str, chunks: List[str]):
+        if self.counts is not None:
+            self.counts[domain] = self.counts.get(domain, 0) + len(chunks)
+        else:
+            # 可能有count_by_domain正在锁外统计，结果里不一定含这批新写入
+            self.generation += 1
+        entry = self.entries.get(domain)
+        if entry is None:
+            # 没缓存的领域可能正有get_knowledge在锁外读存储，读到的可能不含这批新写入，不能让它放进缓存
+            self.generation += 1
+            return
+        size = self._size(chunks)
+        entry[0].extend(chunks)
+        self.entries[domain] = (entry[0], entry[1] + size)
+        self.total_bytes += size
+        self._evict()
+
+    def discard(self, domain: str):
+        entry = self.entries.pop(domain, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def clear(self):
+        """知识库被清空时调用：计数直接置为空，清空前开始的读取结果作废"""
+        self.generation += 1
+        self.entries.clear()
+        self.total_bytes = 0
+        self.counts = {}
+
+    def invalidate(self):
+        self.generation += 1
+        self.entries.clear()
+        self.total_bytes = 0
+        self.counts = None
+
 
 # 孩子们这个更是传奇半成品module
 
 class KnowledgeSystem:
-    def __init__(self):
-        self.client = MongoClient(MONGO_URI)
-        self.db = self.client[MONGO_DB.lower()]
-        self.collection = self.db[MONGO_COLLECTION.lower()]
+    def __init__(self, store: KnowledgeStore = None):
+        self.store = store or MongoKnowledgeStore()
         self.raw_files_dir = RAW_FILES_DIR
+        self.manifest_path = MANIFEST_PATH
+        self.index_path = BM25_INDEX_PATH
+        self.index = BM25Index()
+        self.vectors = VectorIndex(VECTOR_DIR, VECTOR_DIM)
+        self.cache = KnowledgeCache(KNOWLEDGE_CACHE_BYTES)
+        # _lock保护内存里的BM25索引和缓存，只在更新它们时短暂持有；
+        # _sync_lock串行化导入、同步、重置这类耗时的写操作和清单，切块和写库期间对话照常检索
+        self._lock = threading.RLock()
+        self._sync_lock = threading.RLock()
+        self._watcher = None
         
         os.makedirs(self.raw_files_dir, exist_ok=True)
         
-        self.reset_knowledge_base()
+        self.manifest = self._load_manifest() if os.path.exists(self.manifest_path) else None
+        if self.manifest is not None and not (self.manifest and self.store.count() == 0):
+            self._rebuild_index()
+            self.sync_knowledge_base()
+        else:
+            # 没有清单(旧版本的库或者第一次启动)，或者清单对应的是另一个存储后端，只能全量重建一次
+            self.manifest = {}
+            self.reset_knowledge_base()
 
     def _split_text(self, text: str) -> List[str]:
-        return [text[i:i+CHUNK_SIZE] for i in range(0, len(text), CHUNK_SIZE)]
+        return split_text(text)
 
-    def reset_knowledge_base(self):
-        self.collection.delete_many({})
+    def _write_docs(self, docs: List[Dict]) -> Tuple[List[int], List[int]]:
+        """按(领域, 内容哈希)去重后写入存储并同步更新内存索引，返回(写入失败的下标, 新写入的下标)
+
+        已经存在的知识块不会重复写入，对应文档的id会改成已存在那条的id
+        """
+        first = {}
+        unique = []
+        for i, doc in enumerate(docs):
+            doc.setdefault("hash", content_hash(doc["content"]))
+            key = (doc["domain"], doc["hash"])
+            if key not in first:
+                first[key] = i
+                unique.append(i)
+        store_failed, existing = self.store.insert_chunks([docs[i] for i in unique])
+        store_failed = set(store_failed)
+        failed = {unique[j] for j in store_failed}
+        for j, chunk_id in existing.items():
+            docs[unique[j]]["id"] = chunk_id
+        inserted = [i for j, i in enumerate(unique) if j not in store_failed and j not in existing]
+        for i, doc in enumerate(docs):
+            origin = first[(doc["domain"], doc["hash"])]
+            if origin != i:
+                doc["id"] = docs[origin]["id"]
+                if origin in failed:
+                    failed.add(i)
+        
+        written = [docs[i] for i in inserted]
+        self.vectors.add([doc["id"] for doc in written], [doc["content"] for doc in written])
+        by_domain = {}
+        for doc in written:
+            by_domain.setdefault(doc["domain"], []).append(doc["content"])
+        with self._lock:
+            if not self.store.supports_search:
+                for doc in written:
+                    self.index.add(doc["id"], doc["content"])
+            for domain, contents in by_domain.items():
+                self.cache.extend(domain, contents)
+        return sorted(failed), inserted
+
+    def _insert_chunks(self, domain: str, chunks: List[str]) -> int:
+        """写入知识块，返回真正新增的条数"""
+        docs = [{"id": self.store.new_id(), "domain": domain, "content": chunk} for chunk in chunks]
+        if not docs:
+            return 0
+        _, inserted = self._write_docs(docs)
+        return len(inserted)
+
+    def _delete_chunks(self, chunk_ids: List[str]):
+        if not chunk_ids:
+            return
+        # BM25索引里不存内容，删除前先取出来，才知道要从哪些倒排表里去掉
+        contents = self._get_contents(chunk_ids) if not self.store.supports_search else {}
+        self.store.delete_chunks(chunk_ids)
+        self.vectors.remove(chunk_ids)
+        with self._lock:
+            # 删完再失效，删除前开始的读取结果不会被放进缓存
+            self.cache.invalidate()
+            for chunk_id in chunk_ids:
+                self.index.remove(chunk_id, contents.get(chunk_id))
+
+    def _get_contents(self, chunk_ids: List[str]) -> Dict[str, str]:
+        contents = {}
+        for i in range(0, len(chunk_ids), INSERT_BATCH_SIZE):
+            for chunk_id, (_, content) in self.store.get_chunks(chunk_ids[i:i + INSERT_BATCH_SIZE]).items():
+                contents[chunk_id] = content
+        return contents
+
+    def _rebuild_index(self):
+        if not self.store.supports_search and not (os.path.exists(self.index_path)
+                                                   and self.index.load(self.index_path)
+                                                   and len(self.index) == self.store.count()):
+            # 索引文件缺失、损坏或者和数据库对不上，整体重建一次
+            self.index.clear()
+            for doc in self.store.iter_chunks(batch_size=INSERT_BATCH_SIZE, with_ids=True):
+                self.index.add(doc["id"], doc["content"])
+            self.index.save(self.index_path)
+        if len(self.vectors) != self.store.count():
+            # 向量文件和数据库对不上(第一次启动、切换了存储或者文件损坏)，整体重建
+            self.vectors.clear()
+            batch = []
+            for doc in self.store.iter_chunks(batch_size=INSERT_BATCH_SIZE, with_ids=True):
+                batch.append(doc)
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    self.vectors.add([d["id"] for d in batch], [d["content"] for d in batch])
+                    batch = []
+            self.vectors.add([d["id"] for d in batch], [d["content"] for d in batch])
+
+    def _list_raw_files(self) -> List[str]:
+        return [os.path.normpath(path) for path in glob.glob(os.path.join(self.raw_files_dir, "*.txt"))]
+
+    @staticmethod
+    def _file_digest(file_path: str) -> str:
+        return file_digest(file_path)
+
+    def _load_manifest(self) -> Dict[str, Dict]:
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"读取知识库清单失败: {e}")
+            return {}
+
+    def _save_manifest(self):
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+        if not self.store.supports_search:
+            # 写索引的都持有_sync_lock，这里不会有并发修改，不用占着_lock挡住检索
+            self.index.save(self.index_path)
+
+    @staticmethod
+    def _file_tasks(file_path: str) -> List[Tuple[Callable[..., Dict], tuple]]:
+        """小文件一个任务切完并算哈希；大文件拆成INGEST_SEGMENT_BYTES左右、尽量按行对齐的范围，哈希单独一个任务"""
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = 0  # 交给chunk_file报错
+        if size <= INGEST_SEGMENT_BYTES:
+            return [(chunk_file, (file_path,))]
+        starts = list(range(0, size, INGEST_SEGMENT_BYTES))
+        ends = starts[1:] + [None]  # 最后一段读到文件末尾，期间文件变长也不会漏
+        return [(file_info, (file_path,))] + [(chunk_file_range, (file_path, s, e)) for s, e in zip(starts, ends)]
+
+    @classmethod
+    def _iter_chunked_files(cls, file_paths: List[str], workers: int) -> Iterator[Tuple[str, Optional[Dict], Optional[Exception]]]:
+        """在进程池里读取和切分文件，同时在途的任务数有上限；大文件拆成多个任务，单个结果只有一个范围的量，
+        父进程内存不随文件大小增长。每个文件产出若干 {"chunks": [...]}，最后一条另外带size、mtime、hash；
+        任一任务失败时产出一次(file_path, None, error)，之后不再产出这个文件"""
+        remaining: Dict[str, int] = {}
+        info: Dict[str, Dict] = {}
+        failed = set()
+
+        def tasks() -> Iterator[Tuple[str, Callable[..., Dict], tuple]]:
+            for file_path in file_paths:
+                file_tasks = cls._file_tasks(file_path)
+                remaining[file_path] = len(file_tasks)
+                info[file_path] = {}
+                for fn, args in file_tasks:
+                    if file_path in failed:
+                        break
+                    yield file_path, fn, args
+
+        def finish(file_path: str, result: Optional[Dict], error: Optional[Exception]):
+            if file_path in failed:
+                return None
+            if error is not None:
+                failed.add(file_path)
+                info.pop(file_path)
+                return file_path, None, error
+            chunks = result.pop("chunks", [])
+            info[file_path].update(result)
+            remaining[file_path] -= 1
+            if remaining[file_path]:
+                return file_path, {"chunks": chunks}, None
+            del remaining[file_path]
+            return file_path, {**info.pop(file_path), "chunks": chunks}, None
+
+        if workers <= 1:
+            for file_path, fn, args in tasks():
+                try:
+                    event = finish(file_path, fn(*args), None)
+                except Exception as e:
+                    event = finish(file_path, None, e)
+                if event is not None:
+                    yield event
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = tasks()
+            futures = {}
+            for file_path, fn, args in islice(pending, workers * 2):
+                futures[executor.submit(fn, *args)] = file_path
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_path = futures.pop(future)
+                    try:
+                        event = finish(file_path, future.result(), None)
+                    except Exception as e:
+                        event = finish(file_path, None, e)
+                    if event is not None:
+                        yield event
+                    for next_path, fn, args in islice(pending, 1):
+                        futures[executor.submit(fn, *args)] = next_path
+
+    def _ingest_files(self, file_paths: List[str]) -> Tuple[Dict[str, Dict], int]:
+        """并行切块，单线程批量写入，返回(成功导入的文件的清单条目, 新增知识条数)；单个文件失败不影响其它文件"""
+        entries = {}
+        new_ids = {}
+        failed = set()
+        total = len(file_paths)
+        if not total:
+            return entries, 0
+        workers = min(INGEST_WORKERS or os.cpu_count() or 1, total)
+        pending_docs, pending_refs = [], []
+        start_time = time.time()
         
-        txt_files = glob.glob(os.path.join(self.raw_files_dir, "*.txt"))
-        for file_path in txt_files:
+        def flush():
+            failed_docs, inserted = self._write_docs(pending_docs)
+            for i in failed_docs:
+                file_path = pending_refs[i][0]
+                if file_path not in failed:
+                    failed.add(file_path)
+                    print(f"写入文件 {file_path} 的知识失败")
+            for i in inserted:
+                new_ids[pending_refs[i][0]].append(pending_docs[i]["id"])
+            # 重复的知识块沿用已存在的id
+            for (file_path, position), doc in zip(pending_refs, pending_docs):
+                chunk_ids[file_path][position] = doc["id"]
+            pending_docs.clear()
+            pending_refs.clear()
+        
+        chunk_ids = {}
+        done = 0
+        for file_path, result, error in self._iter_chunked_files(file_paths, workers):
+            if error is not None:
+                done += 1
+                print(f"[{done}/{total}] 加载文件 {file_path} 失败: {error}")
+                if file_path in chunk_ids:
+                    failed.add(file_path)  # 大文件前面几段可能已经写入，一起回滚
+                continue
             domain = os.path.splitext(os.path.basename(file_path))[0]
-            try:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-                    chunks = self._split_text(content)
-                    self.collection.insert_many([
-                        {"domain": domain, "content": chunk}
-                        for chunk in chunks
-                    ])
-                    print(f"已加载 {len(chunks)} 条知识到 '{domain}'")
-            except Exception as e:
-                print(f"加载文件 {file_path} 失败: {e}")
+            if file_path not in chunk_ids:
+                chunk_ids[file_path] = []
+                new_ids[file_path] = []
+            file_chunk_ids = chunk_ids[file_path]
+            for chunk in result.pop("chunks"):
+                doc = {"id": self.store.new_id(), "domain": domain, "content": chunk}
+                pending_refs.append((file_path, len(file_chunk_ids)))
+                pending_docs.append(doc)
+                file_chunk_ids.append(doc["id"])
+                if len(pending_docs) >= INSERT_BATCH_SIZE:
+                    flush()
+            if "hash" in result:
+                done += 1
+                entries[file_path] = {**result, "chunk_ids": file_chunk_ids}
+                print(f"[{done}/{total}] 已加载 {len(file_chunk_ids)} 条知识到 '{domain}'")
+        if pending_docs:
+            flush()
+        
+        for file_path in failed:
+            # 只回滚这次新写入的部分，和别的来源共用的知识块保留
+            entries.pop(file_path, None)
+            self._delete_chunks(new_ids.pop(file_path))
+        for entry in entries.values():
+            entry["chunk_ids"] = list(dict.fromkeys(entry["chunk_ids"]))
+        inserted_count = sum(len(ids) for ids in new_ids.values())
+        print(f"知识导入完成: {len(entries)}/{total} 个文件，新增 {inserted_count} 条，用时 {time.time() - start_time:.2f}秒")
+        return entries, inserted_count
+
+    def sync_knowledge_base(self) -> Tuple[int, int, int]:
+        """对比清单与RAW_FILES_DIR，只处理新增、修改和删除的文件，返回(新增, 更新, 删除)文件数"""
+        added = updated = removed = 0
+        with self._sync_lock:
+            current_files = set(self._list_raw_files())
+            for file_path in list(self.manifest):
+                if file_path not in current_files:
+                    self._delete_chunks(self.manifest.pop(file_path)["chunk_ids"])
+                    print(f"已移除文件 {file_path} 的知识")
+                    removed += 1
+
+            changed = set()
+            to_ingest = []
+            for file_path in sorted(current_files):
+                entry = self.manifest.get(file_path)
+                try:
+                    stat = os.stat(file_path)
+                    if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                        continue
+                    if entry and entry["hash"] == self._file_digest(file_path):
+                        entry["size"], entry["mtime"] = stat.st_size, stat.st_mtime
+                        continue
+                    if entry:
+                        self._delete_chunks(entry["chunk_ids"])
+                        del self.manifest[file_path]
+                        changed.add(file_path)
+                    to_ingest.append(file_path)
+                except Exception as e:
+                    print(f"加载文件 {file_path} 失败: {e}")
+
+            entries, _ = self._ingest_files(to_ingest)
+            self.manifest.update(entries)
+            updated = len(changed & entries.keys())
+            added = len(entries) - updated
+            self._save_manifest()
+        return added, updated, removed
+
+    def start_watcher(self, interval: float = 10.0):
+        """后台轮询RAW_FILES_DIR，文件有变动时自动同步"""
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+        
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    added, updated, removed = self.sync_knowledge_base()
+                    if added or updated or removed:
+                        print(f"知识库已同步: 新增 {added}，更新 {updated}，删除 {removed} 个文件")
+                except Exception as e:
+                    print(f"知识库同步失败: {e}")
+        
+        self._watcher = threading.Thread(target=watch, daemon=True)
+        self._watcher.start()
+
+    def reset_knowledge_base(self):
+        with self._sync_lock:
+            self.store.delete_all()
+            self.vectors.clear()
+            with self._lock:
+                self.index.clear()
+                self.cache.clear()
+            self.manifest, _ = self._ingest_files(self._list_raw_files())
+            self._save_manifest()
 
     def add_knowledge(self, domain: str, knowledge: str):
         try:
             chunks = self._split_text(knowledge)
             if chunks:
-                self.collection.insert_many([
-                    {"domain": domain.lower(), "content": chunk}
-                    for chunk in chunks
-                ])
-                print(f"已添加知识到 '{domain}'")
+                with self._sync_lock:
+                    inserted = self._insert_chunks(domain.lower(), chunks)
+                if inserted:
+                    print(f"已添加知识到 '{domain}'")
+                else:
+                    print(f"'{domain}' 中已有相同的知识")
         except Exception as e:
             print(f"添加知识失败: {str(e)}")
 
+    def iter_knowledge(self, domain: str = None, batch_size: int = 1000) -> Iterator[Tuple[str, str]]:
+        """逐批从游标里读取(领域, 内容)，不会一次性把整个集合拉到内存里"""
+        for doc in self.store.iter_chunks(domain, batch_size):
+            yield doc["domain"], doc["content"]
+
+    def get_knowledge_page(self, domain: str, page: int = 0, page_size: int = 50) -> List[str]:
+        return self.store.get_page(domain, page, page_size)
+
+    def count_by_domain(self) -> Dict[str, int]:
+        """计数有缓存时直接返回；没有时在锁外统计，期间发生写入就不放进缓存"""
+        with self._lock:
+            if self.cache.counts is not None:
+                return dict(self.cache.counts)
+            generation = self.cache.generation
+        counts = self.store.count_by_domain()
+        with self._lock:
+            if generation == self.cache.generation:
+                self.cache.counts = counts
+        return dict(counts)
+
     def get_knowledge(self, domain: str = None) -> Dict[str, List[str]]:
         if domain:
-            cursor = self.collection.find({"domain": domain})
-            return {domain: [doc["content"] for doc in cursor]}
+            with self._lock:
+                chunks = self.cache.get(domain)
+                generation = self.cache.generation
+            if chunks is None:
+                chunks = [content for _, content in self.iter_knowledge(domain)]
+                with self._lock:
+                    self.cache.put(domain, chunks, generation)
+            return {domain: list(chunks)}
+        result = {}
+        for doc_domain, content in self.iter_knowledge():
+            result.setdefault(doc_domain, []).append(content)
+        return result
+
+    def search(self, query: str, top_k: int = 5, min_score: float = 0.0) -> Dict[str, List[str]]:
+        """按BM25相关度返回与query最相关的top_k条知识，格式与get_knowledge一致"""
+        result = {}
+        if self.store.supports_search:
+            hits = [(score, domain, content) for score, _, domain, content in self.store.search(query, top_k)
+                    if score >= min_score]
         else:
-            result = {}
-            for doc in self.collection.find():
-                if doc["domain"] not in result:
-                    result[doc["domain"]] = []
-                result[doc["domain"]].append(doc["content"])
-            return result
+            with self._lock:
+                ranked = self.index.search(query, top_k, min_score)
+            docs = self.store.get_chunks([chunk_id for _, chunk_id in ranked]) if ranked else {}
+            hits = [(score, *docs[chunk_id]) for score, chunk_id in ranked if chunk_id in docs]
+        for _, domain, content in hits:
+            result.setdefault(domain, []).append(content)
+        return result
+
+    def semantic_search(self, query: str, top_k: int = 5, min_score: float = 0.0) -> Dict[str, List[str]]:
+        """按哈希n-gram向量的余弦相似度检索，能找到用词不完全一样的相关知识"""
+        hits = self.vectors.search(query, top_k, min_score)
+        if not hits:
+            return {}
+        docs = self.store.get_chunks([chunk_id for _, chunk_id in hits])
+        result = {}
+        for _, chunk_id in hits:
+            if chunk_id in docs:
+                domain, content = docs[chunk_id]
+                result.setdefault(domain, []).append(content)
+        return result
 
     def get_all_knowledge(self) -> Dict:
+        """知识库概况：每个领域的知识条数，具体内容请用search/iter_knowledge按需读取"""
         return {
-            "general": "通用知识库",
-            "specialized": self.get_knowledge()
+            "general": GENERAL_KNOWLEDGE,
+            "specialized": self.count_by_domain()
         }
 
     def learn_all(self) -> int:
-        count = 0
-        txt_files = glob.glob(os.path.join(self.raw_files_dir, "*.txt"))
-        for file_path in txt_files:
-            domain = os.path.splitext(os.path.basename(file_path))[0]
-            try:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-                    chunks = self._split_text(content)
-                    self.collection.insert_many([
-                        {"domain": domain, "content": chunk}
-                        for chunk in chunks
-                    ])
-                    count += len(chunks)
-            except Exception as e:
-                print(f"加载文件 {file_path} 失败: {e}")
-        return count
+        with self._sync_lock:
+            _, inserted_count = self._ingest_files(self._list_raw_files())
+        return inserted_count
+
+    def compact(self) -> int:
+        """一次性清理库里已有的重复知识块(包括去重功能上线前写入的)，返回删除的条数"""
+        with self._sync_lock:
+            duplicates = self.store.compact()
+            if not duplicates:
+                return 0
+            self.vectors.remove(list(duplicates))
+            # 重复块和保留下来的那条内容相同，用保留的内容定位倒排表
+            contents = self._get_contents(list(set(duplicates.values()))) if not self.store.supports_search else {}
+            with self._lock:
+                self.cache.invalidate()
+                for chunk_id, kept_id in duplicates.items():
+                    self.index.remove(chunk_id, contents.get(kept_id))
+            for entry in self.manifest.values():
+                entry["chunk_ids"] = list(dict.fromkeys(duplicates.get(chunk_id, chunk_id)
+                                                        for chunk_id in entry["chunk_ids"]))
+            self._save_manifest()
+        return len(duplicates)
 
     def forget_all(self):
-        count = self.collection.count_documents({})
-        self.collection.delete_many({})
+        with self._sync_lock:
+            count = self.store.delete_all()
+            self.vectors.clear()
+            with self._lock:
+                self.index.clear()
+                self.cache.clear()
+            self.manifest = {}
+            self._save_manifest()
         return count
 
     def __del__(self):
-        self.client.close()
+        self.store.close()
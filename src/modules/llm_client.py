@@ -0,0 +1,226 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import CancelledError
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.modules.chunker import estimate_tokens
+from src.modules.pipeline import check_cancelled, time_left
+from src.modules.rate_limit import RateLimiter
+
+
+def _request_body(messages: List[Dict], model: str, temperature: float, max_tokens: int, stream: bool) -> Dict:
+    return {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": stream
+    }
+
+
+def _parse_sse_line(line: str) -> Optional[str]:
+    """解析一行SSE数据，返回这一段生成的文字；不是数据行或没有文字时返回None"""
+    if not line.startswith("data:"):
+        return None
+    data = line[5:].strip()
+    if not data or data == "[DONE]":
+        return None
+    choices = json.loads(data).get("choices") or [{}]
+    return (choices[0].get("delta") or {}).get("content")
+
+
+class BackendError(Exception):
+    """后端调用失败，和模型的回复区分开；retryable表示值得重试，retry_after是服务端要求等待的秒数"""
+
+    def __init__(self, message: str, status: Optional[int] = None, retryable: bool = False,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    """Retry-After可以是秒数也可以是HTTP日期"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backend_error(error: requests.RequestException) -> BackendError:
+    """按错误类型判断能不能重试：连接失败、超时、429和5xx可以，其他4xx重试也没用"""
+    response = getattr(error, "response", None)
+    if isinstance(error, requests.HTTPError) and response is not None:
+        status = response.status_code
+        return BackendError(str(error), status, status == 429 or status >= 500, _retry_after(response))
+    retryable = isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+    return BackendError(str(error), retryable=retryable)
+
+
+class LLMClient:
+    """一个后端一个客户端：复用keep-alive连接池，避免每轮对话都重新做TCP+TLS握手；
+    按rpm/tpm在本地限流排队，可重试的错误按指数退避加随机抖动重试"""
+
+    def __init__(self, api_base: str, api_key: str = "", pool_size: int = 4,
+                 connect_timeout: float = 5.0, read_timeout: float = 120.0, rpm: float = 0, tpm: float = 0,
+                 max_retries: int = 3, retry_base_delay: float = 1.0, retry_max_delay: float = 30.0):
+        self.api_base = api_base.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.limiter = RateLimiter(rpm, tpm)
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.retries = 0
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        })
+
+    def _timeout(self, cancel: Optional[threading.Event]) -> Tuple[float, float]:
+        """请求带截止时间时，连接和读取超时都不超过剩下的时间"""
+        remaining = time_left(cancel)
+        if remaining is None:
+            return self.timeout
+        return min(self.timeout[0], remaining), min(self.timeout[1], remaining)
+
+    def _retry_delay(self, attempt: int, error: BackendError) -> float:
+        """full jitter退避；服务端给了Retry-After时至少等这么久，但不超过retry_max_delay"""
+        delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+        if error.retry_after is not None:
+            delay = max(delay, error.retry_after)
+        return min(delay, self.retry_max_delay)
+
+    def _with_retries(self, messages: List[Dict], request: Callable[[], Iterator[str]],
+                      cancel: Optional[threading.Event]) -> Iterator[str]:
+        """限流排队后发出请求；还没有任何输出时遇到可重试的错误就等一会重试，已经有输出的流不能重试"""
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        attempt = 0
+        while True:
+            self.limiter.acquire(prompt_tokens, cancel)
+            produced = 0
+            try:
+                for content in request():
+                    produced += estimate_tokens(content)
+                    yield content
+                return
+            except requests.RequestException as e:
+                # 已经到了截止时间就不再重试，按请求超时抛出
+                check_cancelled(cancel)
+                error = _backend_error(e)
+            except (KeyError, IndexError, ValueError) as e:
+                raise BackendError(f"无法解析的响应: {e}") from e
+            finally:
+                self.limiter.consume(produced)
+            if produced or not error.retryable or attempt >= self.max_retries:
+                raise error
+            if error.retry_after is not None and error.retry_after > self.retry_max_delay:
+                # 服务端要求等太久，与其占着线程空等不如直接报错
+                raise error
+            delay = self._retry_delay(attempt, error)
+            attempt += 1
+            self.retries += 1
+            if cancel is not None:
+                remaining = time_left(cancel)
+                cancel.wait(delay if remaining is None else min(delay, remaining))
+                check_cancelled(cancel)
+            else:
+                time.sleep(delay)
+
+    def chat(self, messages: List[Dict], model: str, temperature: float = 0.7, max_tokens: int = 2000,
+             cancel: Optional[threading.Event] = None) -> str:
+        """等待时间受connect_timeout/read_timeout和取消事件的截止时间限制；请求返回时如果已被取消就丢弃结果。失败时抛出BackendError"""
+        def request() -> Iterator[str]:
+            check_cancelled(cancel)
+            response = self.session.post(
+                f"{self.api_base}/chat/completions",
+                json=_request_body(messages, model, temperature, max_tokens, False),
+                timeout=self._timeout(cancel)
+            )
+            check_cancelled(cancel)
+            response.raise_for_status()
+            yield response.json()["choices"][0]["message"]["content"]
+        return "".join(self._with_retries(messages, request, cancel))
+
+    def chat_stream(self, messages: List[Dict], model: str, temperature: float = 0.7,
+                    max_tokens: int = 2000, cancel: Optional[threading.Event] = None) -> Iterator[str]:
+        """每收到一行检查一次取消，取消后关闭连接停止生成。失败时抛出BackendError"""
+        def request() -> Iterator[str]:
+            with self.session.post(
+                f"{self.api_base}/chat/completions",
+                json=_request_body(messages, model, temperature, max_tokens, True),
+                timeout=self._timeout(cancel),
+                stream=True
+            ) as response:
+                response.raise_for_status()
+                # SSE响应通常不带charset，自己按UTF-8解码，避免中文乱码
+                for line in response.iter_lines():
+                    check_cancelled(cancel)
+                    content = _parse_sse_line(line.decode("utf-8"))
+                    if content:
+                        yield content
+        yield from self._with_retries(messages, request, cancel)
+
+    def probe(self):
+        """轻量健康探测：只请求模型列表，不消耗token；能拿到非5xx响应就说明后端可用，否则抛出BackendError"""
+        try:
+            response = self.session.get(f"{self.api_base}/models", timeout=self.timeout)
+        except requests.RequestException as e:
+            raise _backend_error(e) from e
+        response.close()
+        if response.status_code >= 500:
+            raise BackendError(f"{response.status_code} {response.reason}", response.status_code, True)
+
+    def warmup(self):
+        """后台先发一个轻量请求把连接建好，第一轮对话就不用等握手；请求结果无所谓"""
+        def _warmup():
+            try:
+                self.session.get(f"{self.api_base}/models", timeout=self.timeout).close()
+            except requests.RequestException:
+                pass
+        threading.Thread(target=_warmup, daemon=True).start()
+
+    def close(self):
+        self.session.close()
+
+
+def is_backend_failure(error: Exception) -> bool:
+    """其他4xx是请求本身的问题，后端是好的；连接失败、超时、5xx、429和无法解析的响应都算后端故障"""
+    if isinstance(error, CancelledError):
+        return False
+    if isinstance(error, BackendError) and error.status is not None:
+        return error.status >= 500 or error.status == 429
+    return True
+
+
+def client_options(config: Dict) -> Dict:
+    """从后端配置里取出创建客户端需要的参数"""
+    return {
+        "api_base": config.get("api_base", "https://api.deepseek.com/v1"),
+        "api_key": config.get("api_key", ""),
+        "pool_size": config.get("pool_size", 4),
+        "connect_timeout": config.get("connect_timeout", 5.0),
+        "read_timeout": config.get("read_timeout", 120.0),
+        "rpm": config.get("rpm", 0),
+        "tpm": config.get("tpm", 0),
+        "max_retries": config.get("max_retries", 3),
+        "retry_base_delay": config.get("retry_base_delay", 1.0),
+        "retry_max_delay": config.get("retry_max_delay", 30.0)
+    }
@@ -1,110 +1,385 @@
-from pymongo import MongoClient
-from datetime import datetime, timedelta
+from datetime import datetime
+import atexit
 import threading
-import time
-from typing import Dict, List, Optional
 import math
+import time
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from src.constants import MEMORY_FLUSH_SIZE, MEMORY_FLUSH_INTERVAL, MEMORY_FLUSH_RETRIES, MEMORY_QUEUE_LIMIT, \
+    MEMORY_COMPACT_INTERVAL
+from src.modules.chunker import tokenize
+from src.modules.storage import MemoryStore, MongoMemoryStore
+
+
+def extract_tags(text: str, k: int = 8) -> List[str]:
+    """从文本里取出现最多的k个词作为标签：中文取二元组，英文取长度大于1的单词"""
+    counts = Counter(token for token in tokenize(text) if len(token) > 1)
+    return [token for token, _ in counts.most_common(k)]
+
+
+def _tag_pairs(tags: Iterable[str]) -> List[Tuple[str, str]]:
+    unique = sorted(set(tags))
+    return [(a, b) for i, a in enumerate(unique) for b in unique[i + 1:]]
+
+
+class TagGraph:
+    """标签共现图，记忆写入和删除时增量维护，不再定期全表扫描"""
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self.neighbors: Dict[str, Counter] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def load(self, counts: Dict[str, int], pairs: Dict[Tuple[str, str], int]):
+        with self._lock:
+            self.counts = Counter(counts)
+            self.neighbors = {}
+            for (a, b), count in pairs.items():
+                self.neighbors.setdefault(a, Counter())[b] = count
+                self.neighbors.setdefault(b, Counter())[a] = count
+
+    @staticmethod
+    def deltas(tag_lists: Iterable[List[str]], delta: int) -> Tuple[Counter, Counter]:
+        """把若干条记忆的标签换算成标签计数和共现计数的增量"""
+        counts, pairs = Counter(), Counter()
+        for tags in tag_lists:
+            for tag in set(tags):
+                counts[tag] += delta
+            for pair in _tag_pairs(tags):
+                pairs[pair] += delta
+        return counts, pairs
+
+    def apply(self, counts: Dict[str, int], pairs: Dict[Tuple[str, str], int]):
+        with self._lock:
+            for tag, delta in counts.items():
+                self.counts[tag] += delta
+                if self.counts[tag] <= 0:
+                    del self.counts[tag]
+                    self.neighbors.pop(tag, None)
+            for (a, b), delta in pairs.items():
+                for x, y in ((a, b), (b, a)):
+                    if x not in self.counts:
+                        continue
+                    neighbors = self.neighbors.setdefault(x, Counter())
+                    neighbors[y] += delta
+                    if neighbors[y] <= 0:
+                        del neighbors[y]
+
+    def related_tags(self, tag: str, k: int = 5) -> List[Tuple[str, float]]:
+        """按 共现次数/sqrt(count_a*count_b) 返回最相关的k个标签"""
+        with self._lock:
+            count = self.counts.get(tag, 0)
+            neighbors = self.neighbors.get(tag)
+            if not count or not neighbors:
+                return []
+            scored = [(other, cooc / math.sqrt(count * self.counts[other]))
+                      for other, cooc in neighbors.items() if self.counts.get(other)]
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:k]
+
+    def expand_tags(self, tags: List[str], k: int = 3, min_score: float = 0.3) -> List[str]:
+        """在原标签后面补上强相关的标签，用来扩大记忆召回范围"""
+        expanded = list(dict.fromkeys(tags))
+        seen = set(expanded)
+        for tag in tags:
+            for other, score in self.related_tags(tag, k):
+                if score >= min_score and other not in seen:
+                    seen.add(other)
+                    expanded.append(other)
+        return expanded
+
+class MemoryWriteBuffer:
+    """记忆相关的写操作先进内存队列，后台线程按数量或时间阈值批量写入，调用方不用等数据库"""
+
+    def __init__(self, store: MemoryStore, max_items: int = MEMORY_FLUSH_SIZE,
+                 interval: float = MEMORY_FLUSH_INTERVAL, max_retries: int = MEMORY_FLUSH_RETRIES,
+                 max_queue: int = MEMORY_QUEUE_LIMIT):
+        self.store = store
+        self.max_items = max_items
+        self.interval = interval
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._memories: List[Dict] = []
+        self._conversations: List[Dict] = []
+        self._bumps: Dict[str, Tuple[int, datetime]] = {}  # 同一条记忆的多次访问合并成一次更新
+        self._tag_counts: Counter = Counter()
+        self._tag_pairs: Counter = Counter()
+        self.flush_count = 0
+        self.failures = 0  # 连续失败的批次数
+        self.dropped = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def depth(self) -> int:
+        with self._lock:
+            return len(self._memories) + len(self._conversations) + len(self._bumps)
+
+    def add_memory(self, memory: Dict, tag_counts: Dict[str, int], tag_pairs: Dict[Tuple[str, str], int]):
+        with self._lock:
+            self._memories.append(memory)
+            self._tag_counts.update(tag_counts)
+            self._tag_pairs.update(tag_pairs)
+        self._notify()
+
+    def add_conversation(self, conversation: Dict):
+        with self._lock:
+            self._conversations.append(conversation)
+        self._notify()
+
+    def bump(self, memory_ids: List[str], now: datetime):
+        with self._lock:
+            for memory_id in memory_ids:
+                count, _ = self._bumps.get(memory_id, (0, now))
+                self._bumps[memory_id] = (count + 1, now)
+        self._notify()
+
+    def pending_conversation(self, conversation_id: str) -> Optional[Dict]:
+        with self._lock:
+            for conversation in self._conversations:
+                if conversation["id"] == conversation_id:
+                    return conversation
+        return None
+
+    def _notify(self):
+        if self.depth() >= self.max_items:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"记忆写入错误: {e}")
+
+    def flush(self):
+        """把队列里的写操作一次性写入存储：先插入，再更新标签统计和访问记录；失败时放回队列下次重试"""
+        with self._flush_lock:
+            with self._lock:
+                memories, self._memories = self._memories, []
+                conversations, self._conversations = self._conversations, []
+                bumps, self._bumps = self._bumps, {}
+                tag_counts, self._tag_counts = self._tag_counts, Counter()
+                tag_pairs, self._tag_pairs = self._tag_pairs, Counter()
+            if not (memories or conversations or bumps):
+                return
+            start = time.perf_counter()
+            try:
+                if memories:
+                    self._insert(self.store.insert_memories, memories, "记忆")
+                    memories = []
+                if tag_counts:
+                    self.store.update_tag_stats(tag_counts, tag_pairs)
+                    tag_counts, tag_pairs = Counter(), Counter()
+                if conversations:
+                    self._insert(self.store.insert_conversations, conversations, "对话")
+                    conversations = []
+                if bumps:
+                    self.store.bump_memories(bumps)
+                    bumps = {}
+                self.failures = 0
+            except Exception:
+                self.failures += 1
+                raise
+            finally:
+                if memories or conversations or bumps or tag_counts:
+                    self._requeue(memories, conversations, bumps, tag_counts, tag_pairs)
+            self.last_flush_latency = time.perf_counter() - start
+            self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+            self.flush_count += 1
+
+    def _insert(self, insert: Callable[[List[Dict]], List[str]], items: List[Dict], name: str):
+        """批量插入；同一批连续失败max_retries次后改为逐条插入，丢掉单独也写不进去的条目，
+        不让一条坏数据卡住整个队列。逐条全部失败说明是数据库不可用，整批抛出等下次重试"""
+        try:
+            insert(items)
+            return
+        except Exception:
+            if self.failures < self.max_retries or len(items) < 2:
+                raise
+        bad = []
+        error = None
+        for item in items:
+            try:
+                insert([item])
+            except Exception as e:
+                bad.append(item)
+                error = e
+        if len(bad) == len(items):
+            raise error
+        if bad:
+            self.dropped += len(bad)
+            print(f"丢弃{len(bad)}条无法写入的{name}: {error}")
+
+    def _requeue(self, memories: List[Dict], conversations: List[Dict], bumps: Dict[str, Tuple[int, datetime]],
+                 tag_counts: Counter, tag_pairs: Counter):
+        with self._lock:
+            self._memories[:0] = memories
+            self._conversations[:0] = conversations
+            for memory_id, (count, last_accessed) in bumps.items():
+                pending, latest = self._bumps.get(memory_id, (0, last_accessed))
+                self._bumps[memory_id] = (pending + count, max(latest, last_accessed))
+            self._tag_counts.update(tag_counts)
+            self._tag_pairs.update(tag_pairs)
+            # 数据库长时间不可用时不能无限堆积，超出上限丢弃最旧的
+            dropped = 0
+            for queue in (self._memories, self._conversations):
+                excess = len(queue) - self.max_queue
+                if excess > 0:
+                    del queue[:excess]
+                    dropped += excess
+            for memory_id in list(self._bumps)[:max(0, len(self._bumps) - self.max_queue)]:
+                del self._bumps[memory_id]
+                dropped += 1
+        if dropped:
+            self.dropped += dropped
+            print(f"记忆写入队列已满，丢弃{dropped}条最旧的写操作")
+
+    def stats(self) -> Dict:
+        return {
+            "queue_depth": self.depth(),
+            "flush_count": self.flush_count,
+            "dropped": self.dropped,
+            "last_flush_ms": self.last_flush_latency * 1000,
+            "max_flush_ms": self.max_flush_latency * 1000
+        }
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=self.interval + 1)
+        self.flush()
+
 
 # 孩子们这个还没写完，哈基bot的大脑还不完善
 class MemorySystem:
-    def __init__(self, db_name: str = "NeuroBot", host: str = "localhost", port: int = 27017):
-        self.client = MongoClient(host, port)
-        self.db = self.client[db_name]
-        self.memories = self.db.memories
-        self.conversations = self.db.conversations
+    def __init__(self, db_name: str = "NeuroBot", host: str = "localhost", port: int = 27017,
+                 store: MemoryStore = None):
+        self.store = store or MongoMemoryStore(db_name, host, port)
+        self.last_compaction: Dict[str, float] = {}
+        self.tag_graph = TagGraph()
+        self._load_tag_graph()
+        self.write_buffer = MemoryWriteBuffer(self.store)
+        atexit.register(self.close)
         
         self.memory_thread = threading.Thread(target=self._manage_memories, daemon=True)
         self.memory_thread.start()
 
     def store_memory(self, content: str, tags: List[str] = None, metadata: Dict = None) -> str:
         memory = {
+            "id": self.store.new_id(),
             "content": content,
             "tags": tags or [],
             "metadata": metadata or {},
             "created_at": datetime.utcnow(),
             "last_accessed": datetime.utcnow(),
-            "weight": 1.0,  
+            "base_weight": 1.0,
             "access_count": 1 
         }
-        result = self.memories.insert_one(memory)
-        return str(result.inserted_id)
+        counts, pairs = TagGraph.deltas([memory["tags"]], 1)
+        self.tag_graph.apply(counts, pairs)
+        self.write_buffer.add_memory(memory, counts, pairs)
+        return memory["id"]
         
-    def retrieve_memories(self, tags: List[str] = None, limit: int = 10) -> List[Dict]:
-        query = {"tags": {"$in": tags}} if tags else {}
-        return list(self.memories.find(query).limit(limit))
+    def retrieve_memories(self, tags: List[str] = None, limit: int = 10, expand: bool = True) -> List[Dict]:
+        if tags and expand:
+            tags = self.tag_graph.expand_tags(tags)
+        return self.store.find_memories(tags, limit)
+
+    def recall(self, tags: List[str], limit: int = 5, expand: bool = True) -> List[Dict]:
+        """按标签重合度、权重和新近程度召回得分最高的记忆，访问记录交给写缓冲合并写入"""
+        if tags and expand:
+            tags = self.tag_graph.expand_tags(tags)
+        now = datetime.utcnow()
+        memories = self.store.recall_memories(tags or [], limit, now)
+        self.write_buffer.bump([memory["id"] for memory in memories], now)
+        return memories
+
+    def related_tags(self, tag: str, k: int = 5) -> List[Tuple[str, float]]:
+        return self.tag_graph.related_tags(tag, k)
+
+    def expand_tags(self, tags: List[str]) -> List[str]:
+        return self.tag_graph.expand_tags(tags)
+
+    def _load_tag_graph(self):
+        """从存储加载标签统计；老数据还没有统计时全量扫描一次并写回"""
+        counts, pairs = self.store.load_tag_stats()
+        if not counts:
+            counts, pairs = TagGraph.deltas((memory["tags"] for memory in self.store.iter_memories()), 1)
+            if counts:
+                self.store.update_tag_stats(counts, pairs)
+        self.tag_graph.load(counts, pairs)
+
+    def _update_tag_stats(self, tag_lists: List[List[str]], delta: int):
+        counts, pairs = TagGraph.deltas(tag_lists, delta)
+        if not counts:
+            return
+        self.store.update_tag_stats(counts, pairs)
+        self.tag_graph.apply(counts, pairs)
         
     def store_conversation(self, messages: List[Dict], metadata: Dict = None) -> str:
         conversation = {
+            "id": self.store.new_id(),
             "messages": messages,
             "metadata": metadata or {},
             "created_at": datetime.utcnow()
         }
-        result = self.conversations.insert_one(conversation)
-        return str(result.inserted_id)
+        self.write_buffer.add_conversation(conversation)
+        return conversation["id"]
         
     def retrieve_conversation(self, conversation_id: str) -> Optional[Dict]:
-        from bson.objectid import ObjectId
-        return self.conversations.find_one({"_id": ObjectId(conversation_id)})
+        return self.write_buffer.pending_conversation(conversation_id) or self.store.get_conversation(conversation_id)
+        
+    def get_summary(self, session_id: str) -> str:
+        return self.store.get_summary(session_id) or ""
+
+    def save_summary(self, session_id: str, summary: str):
+        self.store.save_summary(session_id, summary, datetime.utcnow())
         
     def update_memory_access(self, memory_id: str):
-        from bson.objectid import ObjectId
-        self.memories.update_one(
-            {"_id": ObjectId(memory_id)},
-            {
-                "$set": {"last_accessed": datetime.utcnow()},
-                "$inc": {"access_count": 1},
-                "$mul": {"weight": 1.1}  #
-            }
-        )
+        self.write_buffer.bump([memory_id], datetime.utcnow())
+
+    def write_stats(self) -> Dict:
+        """写缓冲的队列长度和批量写入耗时"""
+        return self.write_buffer.stats()
+
+    def flush(self):
+        self.write_buffer.flush()
+
+    def close(self):
+        """退出前把缓冲里的写操作全部落盘"""
+        self.write_buffer.close()
 
     def _manage_memories(self):
-        """定期管理哈基bot的大脑"""
+        """权重在读取时按闭式衰减现算，后台只需要偶尔把过期的记忆清掉"""
         while True:
             try:
-                old_date = datetime.utcnow() - timedelta(days=7)
-                self.memories.update_many(
-                    {"last_accessed": {"$lt": old_date}},
-                    {"$mul": {"weight": 0.9}}
-                )
-
-                # 哈基bot鱼一般的记忆力
-                self.memories.delete_many({"weight": {"$lt": 0.1}})
-
-                all_memories = self.memories.find()
-                for memory in all_memories:
-                    age = (datetime.utcnow() - memory["created_at"]).days + 1
-                    access_rate = memory["access_count"] / age
-                    new_weight = min(1.0, access_rate * math.log10(age + 1))
-                    
-                    self.memories.update_one(
-                        {"_id": memory["_id"]},
-                        {"$set": {"weight": new_weight}}
-                    )
-
-                self._optimize_tag_relationships()
-
+                self.compact()
             except Exception as e:
                 print(f"记忆管理错误: {e}")
             
-            time.sleep(1800)  # 每30分钟对着自己大脑哈一次气
+            time.sleep(MEMORY_COMPACT_INTERVAL)
 
-    def _optimize_tag_relationships(self):
-        """优化标签之间的关系权重"""
-        tags_count = {}
-        tag_pairs = {}
-        
-        memories = self.memories.find()
-        for memory in memories:
-            tags = memory["tags"]
-            for tag in tags:
-                tags_count[tag] = tags_count.get(tag, 0) + 1
-                for other_tag in tags:
-                    if tag != other_tag:
-                        pair = tuple(sorted([tag, other_tag]))
-                        tag_pairs[pair] = tag_pairs.get(pair, 0) + 1
-
-        for tag, count in tags_count.items():
-            self.memories.update_many(
-                {"tags": tag},
-                {"$set": {f"tag_weights.{tag}": count / len(tags_count)}}
-            )
+    def compact(self) -> int:
+        """删除已过期的记忆并同步标签统计，返回删除条数"""
+        start = time.perf_counter()
+        self.write_buffer.flush()
+        # 哈基bot鱼一般的记忆力
+        deleted_tags = self.store.purge_expired(datetime.utcnow())
+        self._update_tag_stats(deleted_tags, -1)
+        self.last_compaction = {"purged": len(deleted_tags), "duration": time.perf_counter() - start}
+        if deleted_tags:
+            print(f"记忆整理完成: 清理过期记忆 {len(deleted_tags)} 条, 耗时 {self.last_compaction['duration']:.2f}s")
+        return len(deleted_tags)
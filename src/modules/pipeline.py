@@ -0,0 +1,78 @@
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError
+from typing import Callable, Optional
+
+
+class CancelEvent(threading.Event):
+    """取消事件，可以带一个截止时间(time.monotonic)。后台请求按剩余时间收紧HTTP超时，
+    调用方等待超时的同时工作线程也结束，不会继续占着线程池"""
+
+    def __init__(self, deadline: Optional[float] = None):
+        super().__init__()
+        self.deadline = deadline
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+
+class RequestHandle:
+    """一次已提交请求的句柄：调用方可以等待结果，也可以随时取消。
+    取消后调用方立刻返回，后台请求在下一个检查点(连接返回、每个流式分片)停下，不再执行命令和记录对话"""
+
+    def __init__(self, future: Future, cancel_event: CancelEvent):
+        self.future = future
+        self.cancel_event = cancel_event
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.future.cancel()
+
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self, timeout: Optional[float] = None) -> str:
+        """超时抛出concurrent.futures.TimeoutError(提交时给了timeout的请求到时间会自行停下，否则不会自动取消)，
+        已取消时抛出CancelledError"""
+        if self.cancel_event.is_set():
+            raise CancelledError()
+        return self.future.result(timeout)
+
+
+class RequestPipeline:
+    """ChatBot持有的常驻线程池，并发请求数有上限，不再每条消息新建线程池"""
+
+    def __init__(self, max_workers: int = 4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat-request")
+
+    def submit(self, fn: Callable[[threading.Event], str], timeout: Optional[float] = None) -> RequestHandle:
+        """fn接收取消事件，应该在合适的检查点查看它；给了timeout时从提交起算，超过后请求自行停下"""
+        cancel_event = CancelEvent(time.monotonic() + timeout if timeout is not None else None)
+        return RequestHandle(self.executor.submit(fn, cancel_event), cancel_event)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def check_cancelled(cancel_event: Optional[threading.Event]):
+    """已取消时抛出CancelledError；已过截止时间时抛出concurrent.futures.TimeoutError，
+    调用方不管是自己等超时还是后台请求先到截止时间，拿到的都是同一种超时"""
+    if cancel_event is None:
+        return
+    if cancel_event.is_set():
+        raise CancelledError()
+    if isinstance(cancel_event, CancelEvent) and cancel_event.expired():
+        raise TimeoutError()
+
+
+def time_left(cancel_event: Optional[threading.Event]) -> Optional[float]:
+    """距离截止时间还剩多少秒，没有截止时间时返回None"""
+    return cancel_event.remaining() if isinstance(cancel_event, CancelEvent) else None
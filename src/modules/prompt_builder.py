@@ -1,41 +1,148 @@
+from typing import Dict, List, Optional, Tuple
+
+from src.modules.chunker import estimate_tokens
+
+# 各部分默认的token预算；系统提示和工具说明是固定前缀，不参与压缩
+DEFAULT_BUDGETS = {"history": 1500, "knowledge": 1200, "memory": 300}
+# 总预算不够时从优先级最低的部分开始压缩
+SECTION_PRIORITY = ("history", "knowledge", "memory")
+SECTION_NAMES = {"prefix": "固定前缀", "input": "输入", "history": "对话", "knowledge": "知识", "memory": "记忆"}
+
+# 孩子们prompt你们自己改，这个是我自己的prompt
+SYSTEM_PROMPT = """
+        你的网名叫{name}，{background}。
+        现在请你读读之前的聊天记录，然后给出日常且口语化的回复，平淡一些，
+        尽量简短一些。请注意把握聊天内容，不要刻意突出自身学科背景，不要回复的太有条理，可以有接近于网友的个性。
+        请回复的平淡一些，简短一些，在提到时不要过多提及自身的背景。
+        """
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """二分查找能放进max_tokens的最长前缀"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+
+def fit_units(units: List[str], budget: int, contiguous: bool = False) -> Tuple[List[int], int]:
+    """按顺序(越靠前越重要)挑选能放进预算的片段，返回选中的下标和用掉的token数；
+    第一条就放不下时截断它，保证最重要的内容至少有一部分；contiguous时遇到放不下的就停止，只保留连续的开头部分"""
+    kept, used = [], 0
+    for index, unit in enumerate(units):
+        tokens = estimate_tokens(unit)
+        if used + tokens <= budget:
+            kept.append(index)
+            used += tokens
+        elif not kept and budget > 0:
+            units[index] = truncate_to_tokens(unit, budget)
+            kept.append(index)
+            used += estimate_tokens(units[index])
+        elif contiguous:
+            break
+    return kept, used
+
+
 class PromptBuilder:
-    def __init__(self, persona=None):
+    def __init__(self, persona=None, budgets: Optional[Dict[str, int]] = None, max_tokens: int = 4000,
+                 tools: str = ""):
         self.persona = persona or {
             "name": "AI助手",
             "traits": "友好、专业、乐于助人",
             "background": "我是一个智能AI助手，旨在为用户提供有用的信息和帮助。"
         }
-        
-        # 孩子们prompt你们自己改，这个是我自己的prompt
-        self.system_prompt = """
-        你的网名叫{name}，{background}。
-        现在请你读读之前的聊天记录，然后给出日常且口语化的回复，平淡一些，
-        尽量简短一些。请注意把握聊天内容，不要刻意突出自身学科背景，不要回复的太有条理，可以有接近于网友的个性。
-        请回复的平淡一些，简短一些，在提到时不要过多提及自身的背景。
-        """
-        
-        self.system_prompt = self.system_prompt.format(
+        self.tools = tools
+        self.budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+        self.max_tokens = max_tokens
+        self.last_report: Dict[str, Dict[str, int]] = {}
+        self._compile_prefix()
+
+    def _compile_prefix(self):
+        """系统提示+人设+工具说明只在初始化和修改人设时生成一次，每轮请求的前缀逐字节相同，服务端的前缀缓存才能命中"""
+        self.system_prompt = SYSTEM_PROMPT.format(
             name=self.persona["name"],
             background=self.persona["background"]
         )
+        self.static_prefix = self.system_prompt + (f"\n\n{self.tools}" if self.tools else "")
+        self.prefix_tokens = estimate_tokens(self.static_prefix)
+
+    def update_persona(self, name: str = None, traits: str = None, background: str = None):
+        self.persona = {
+            **self.persona,
+            **{key: value for key, value in (("name", name), ("traits", traits), ("background", background)) if value}
+        }
+        self._compile_prefix()
+
+    @staticmethod
+    def _knowledge_units(knowledge_base: dict) -> List[str]:
+        units = []
+        for domain, items in knowledge_base.items():
+            if isinstance(items, dict):
+                for key, value in items.items():
+                    for item in value if isinstance(value, list) else [value]:
+                        units.append(f"{domain} - {key}: {item}\n")
+            else:
+                units.append(f"{domain}: {items}\n")
+        return units
+
+    def build_messages(self, user_input: str, knowledge_base: dict, conversation_history: list,
+                       memories: list = None, summary: str = "") -> List[Dict[str, str]]:
+        """固定前缀作为system消息，接着是原生的user/assistant历史消息，本轮的知识、记忆、摘要和输入放在最后一条；
+        按各部分的token预算挑选内容，总量超出max_tokens时先压缩优先级低的部分，每部分用掉的token数记录在last_report里"""
+        history = list(conversation_history or [])
+        units = {
+            # 最近的消息最重要
+            "history": [msg["content"] for msg in reversed(history)],
+            "knowledge": self._knowledge_units(knowledge_base or {}),
+            "memory": [f"- {memory['content']}\n" for memory in memories or []]
+        }
+        summary_text = f"之前的对话摘要:\n{summary}\n\n" if summary else ""
+        input_text = f"用户输入: {user_input}"
+        fixed = self.prefix_tokens + estimate_tokens(summary_text) + estimate_tokens(input_text)
+
+        budgets = {section: max(0, self.budgets.get(section, 0)) for section in units}
+        fitted = {section: fit_units(units[section], budgets[section], section == "history") for section in units}
+        overflow = fixed + sum(used for _, used in fitted.values()) - self.max_tokens
+        for section in reversed(SECTION_PRIORITY):
+            if overflow <= 0:
+                break
+            _, used = fitted[section]
+            budgets[section] = max(0, used - overflow)
+            fitted[section] = fit_units(units[section], budgets[section], section == "history")
+            overflow -= used - fitted[section][1]
+
+        messages = [{"role": "system", "content": self.static_prefix}]
+        # 历史消息只保留最新的连续若干条，并按时间顺序放回去
+        kept_history = len(fitted["history"][0])
+        for offset in range(kept_history - 1, -1, -1):
+            msg = history[len(history) - 1 - offset]
+            messages.append({"role": msg["role"], "content": units["history"][offset]})
+
+        context = summary_text
+        if fitted["knowledge"][0]:
+            context += "相关知识:\n" + "".join(units["knowledge"][i] for i in sorted(fitted["knowledge"][0])) + "\n"
+        if fitted["memory"][0]:
+            context += "相关记忆:\n" + "".join(units["memory"][i] for i in sorted(fitted["memory"][0])) + "\n"
+        messages.append({"role": "user", "content": context + input_text if context else user_input})
+
+        self.last_report = {
+            "prefix": {"tokens": self.prefix_tokens, "kept": 1, "total": 1},
+            "input": {"tokens": fixed - self.prefix_tokens, "kept": 1, "total": 1},
+            **{section: {"tokens": fitted[section][1], "kept": len(fitted[section][0]), "total": len(units[section])}
+               for section in units}
+        }
+        return messages
 
-    def build_prompt(self, user_input: str, knowledge_base: dict, conversation_history: list) -> str:
-        prompt = self.system_prompt + "\n\n"
-        prompt += f"用户输入: {user_input}\n\n"
-        
-        if knowledge_base:
-            prompt += "相关知识:\n"
-            for domain, items in knowledge_base.items():
-                if isinstance(items, dict):
-                    for key, value in items.items():
-                        prompt += f"{domain} - {key}: {value}\n"
-                else:
-                    prompt += f"{domain}: {items}\n"
-        
-        if conversation_history:
-            prompt += "\n最近对话:\n"
-            for msg in conversation_history[-3:]:
-                role = "用户" if msg["role"] == "user" else self.persona["name"]
-                prompt += f"{role}: {msg['content']}\n"
-        
-        return prompt
\ No newline at end of file
+    def format_report(self) -> str:
+        """调试用：每部分用掉的token数和保留的条数"""
+        parts = [f"{SECTION_NAMES[section]} {item['tokens']}" +
+                 (f"({item['kept']}/{item['total']}条)" if section not in ("prefix", "input") else "")
+                 for section, item in self.last_report.items()]
+        total = sum(item["tokens"] for item in self.last_report.values())
+        return f"提示词token估算: {', '.join(parts)}, 合计 {total}/{self.max_tokens}"
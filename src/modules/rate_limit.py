@@ -0,0 +1,58 @@
+import threading
+import time
+from typing import Optional
+
+from src.modules.pipeline import check_cancelled
+
+
+class TokenBucket:
+    """每分钟补充per_minute个令牌，最多攒一分钟的量；不够时排队等待而不是直接失败"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        """调用时需持有锁"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1, cancel: Optional[threading.Event] = None):
+        # 单次需求超过桶容量时按容量算，否则永远等不到
+        amount = min(amount, self.capacity)
+        with self._cond:
+            while True:
+                check_cancelled(cancel)
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                self._cond.wait(min((amount - self.tokens) / self.rate, 0.5))
+
+    def consume(self, amount: float):
+        """事后扣除(比如生成的token数)，可以扣成负数，后面的请求会多等一会"""
+        with self._cond:
+            self._refill()
+            self.tokens -= amount
+
+
+class RateLimiter:
+    """单个后端的请求数(rpm)和token数(tpm)限制，0表示不限制"""
+
+    def __init__(self, rpm: float = 0, tpm: float = 0):
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+
+    def acquire(self, prompt_tokens: int, cancel: Optional[threading.Event] = None):
+        if self.requests is not None:
+            self.requests.acquire(1, cancel)
+        if self.tokens is not None:
+            self.tokens.acquire(prompt_tokens, cancel)
+
+    def consume(self, completion_tokens: int):
+        if self.tokens is not None:
+            self.tokens.consume(completion_tokens)
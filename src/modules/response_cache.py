@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, TimeoutError, wait
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from src.modules.pipeline import check_cancelled
+
+
+def is_cacheable(response: str) -> bool:
+    """带<execute>块的回复每次都要真正执行命令，不能缓存重放"""
+    return "<execute>" not in response
+
+
+class ResponseCache:
+    """完全相同的请求(后端、模型、温度、完整消息列表)直接复用之前的回复；按TTL过期、按条数LRU淘汰，
+    可以持久化到磁盘；同一时刻的相同请求只向后端发一次"""
+
+    def __init__(self, max_entries: int = 500, ttl: float = 3600, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()  # key -> (回复, 过期时间)
+        self.inflight: Dict[str, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def make_key(backend: str, model: str, temperature: float, messages: List[Dict]) -> str:
+        payload = json.dumps([backend, model, temperature, messages], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _get(self, key: str) -> Optional[str]:
+        """调用时需持有锁"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def _put(self, key: str, response: str):
+        """调用时需持有锁"""
+        self.entries[key] = (response, time.time() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _claim(self, key: str) -> Tuple[Optional[str], Optional[Future], bool]:
+        """返回(命中的回复, 进行中请求的Future, 是否由自己发起请求)"""
+        with self._lock:
+            response = self._get(key)
+            if response is not None:
+                self.hits += 1
+                return response, None, False
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                self.misses += 1
+                future = self.inflight[key] = Future()
+            else:
+                self.coalesced += 1
+            return None, future, leader
+
+    def _settle(self, key: str, future: Future, response: Optional[str] = None, error: Optional[BaseException] = None):
+        """发起方结束：可缓存的回复写入缓存，再唤醒等待方；没有回复(被取消)或不可缓存时等待方拿到None"""
+        cacheable = response is not None and is_cacheable(response)
+        with self._lock:
+            if cacheable:
+                self._put(key, response)
+            del self.inflight[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(response if cacheable else None)
+
+    def get_or_compute(self, key: str, compute: Callable[[], str]) -> str:
+        """命中直接返回；相同请求正在进行时等它的结果；否则自己调用compute。
+        compute抛出的异常会同样抛给一起等待的调用方；不可缓存的回复和被取消的请求不共享，等待方各自重新请求"""
+        response, future, leader = self._claim(key)
+        if response is not None:
+            return response
+        if not leader:
+            response = future.result()
+            return response if response is not None else compute()
+
+        try:
+            response = compute()
+        except (CancelledError, TimeoutError):
+            # 发起方取消或者到了它自己的截止时间，等待方各自重新请求
+            self._settle(key, future)
+            raise
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, response)
+        return response
+
+    def stream_or_compute(self, key: str, stream: Callable[[], Iterator[str]],
+                          cancel: Optional[threading.Event] = None) -> Iterator[str]:
+        """get_or_compute的流式版本：命中时整段回放；相同请求正在进行时等它结束，再整段回放它的回复；
+        否则自己发起请求，边生成边吐出，结束后写入缓存。等待期间可以通过cancel停止等待"""
+        response, future, leader = self._claim(key)
+        if response is not None:
+            yield response
+            return
+        if not leader:
+            while not wait([future], timeout=0.1).done:
+                check_cancelled(cancel)
+            response = future.result()
+            if response is not None:
+                yield response
+            else:
+                yield from stream()
+            return
+
+        parts = []
+        try:
+            for delta in stream():
+                parts.append(delta)
+                yield delta
+        except (CancelledError, TimeoutError, GeneratorExit):
+            # 发起方取消、超时或者不再读取了，等待方各自重新请求
+            self._settle(key, future)
+            raise
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, "".join(parts))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except Exception as e:
+            print(f"读取回复缓存失败: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for key, (response, expires_at) in entries.items():
+                if expires_at > now:
+                    self.entries[key] = (response, expires_at)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        now = time.time()
+        with self._lock:
+            entries = {key: list(entry) for key, entry in self.entries.items() if entry[1] > now}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
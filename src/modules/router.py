@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from src.modules.pipeline import CancelEvent, check_cancelled
+
+T = TypeVar("T")
+
+
+class BackendStats:
+    """单个后端的延迟EWMA、错误率EWMA和最近的延迟样本(用来算p95)"""
+
+    def __init__(self, alpha: float, window: int = 50):
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.samples: deque = deque(maxlen=window)
+
+    def record(self, latency: Optional[float], ok: bool):
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok and latency is not None:
+            self.latency = latency if self.latency is None else self.latency + self.alpha * (latency - self.latency)
+            self.samples.append(latency)
+
+    def record_censored(self, elapsed: float):
+        """被取消的请求：只知道延迟至少是elapsed，只往上修正延迟，不计入成功或失败"""
+        if self.latency is None or elapsed > self.latency:
+            self.latency = elapsed if self.latency is None else self.latency + self.alpha * (elapsed - self.latency)
+        self.samples.append(elapsed)
+
+    def p95(self) -> Optional[float]:
+        if len(self.samples) < 5:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class BackendRouter:
+    """在多个后端之间按延迟路由：优先选EWMA延迟最低(按错误率加权)的健康后端；
+    开启对冲时，主请求超过它的p95延迟还没完成就向次优后端再发一份，谁先完成用谁，另一个取消。
+    流式请求的延迟按首字时间统计"""
+
+    def __init__(self, backends: List[str], hedge: bool = True, hedge_delay: float = 2.0,
+                 hedge_min_delay: float = 0.5, alpha: float = 0.3, max_workers: int = 8):
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay  # 样本不够算p95时使用
+        self.hedge_min_delay = hedge_min_delay
+        self.stats: Dict[str, BackendStats] = {backend: BackendStats(alpha) for backend in backends}
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="router")
+
+    def record(self, backend: str, latency: Optional[float], ok: bool):
+        with self._lock:
+            self.stats[backend].record(latency, ok)
+
+    def record_censored(self, backend: str, elapsed: float):
+        with self._lock:
+            self.stats[backend].record_censored(elapsed)
+
+    def rank(self, available: Callable[[str], bool]) -> List[str]:
+        """按预期延迟从低到高排序；没有样本的后端排在前面，先试一下。全都不可用时按原顺序返回全部"""
+        candidates = [backend for backend in self.backends if available(backend)] or list(self.backends)
+        with self._lock:
+            def score(backend: str) -> float:
+                stats = self.stats[backend]
+                if stats.latency is None:
+                    return 0.0
+                return stats.latency / max(1.0 - stats.error_rate, 0.05)
+            return sorted(candidates, key=score)
+
+    def delay_for(self, backend: str) -> float:
+        with self._lock:
+            p95 = self.stats[backend].p95()
+        return max(self.hedge_min_delay, p95 if p95 is not None else self.hedge_delay)
+
+    def race(self, backends: List[str], attempt: Callable[[str, threading.Event], T],
+             cancel: Optional[threading.Event] = None, discard: Optional[Callable[[T], None]] = None) -> T:
+        """在backends[0]上发起请求，需要时在backends[1]上对冲；主请求直接失败时立刻换下一个。
+        返回最先成功的结果，其余请求通过各自的取消事件停止；晚到的结果交给discard清理"""
+        queue = list(backends[:2] if self.hedge else backends[:1])
+        if len(backends) > 1 and not self.hedge:
+            queue.append(backends[1])  # 不对冲时仍然用次优后端做故障转移
+        running: Dict[Future, Tuple[str, threading.Event, float]] = {}
+        last_error: Optional[BaseException] = None
+
+        def launch():
+            backend = queue.pop(0)
+            # 对冲出去的请求继承调用方的截止时间
+            event = CancelEvent(cancel.deadline if isinstance(cancel, CancelEvent) else None)
+            running[self._executor.submit(self._timed, backend, attempt, event)] = (backend, event, time.perf_counter())
+            return backend
+
+        primary = launch()
+        hedge_at = time.monotonic() + self.delay_for(primary)
+        try:
+            while running:
+                check_cancelled(cancel)
+                timeout = 0.1
+                if self.hedge and queue and len(running) == 1:
+                    timeout = min(timeout, max(0.0, hedge_at - time.monotonic()))
+                done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    backend, _, _ = running.pop(future)
+                    if future.exception() is None:
+                        if backend != primary:
+                            with self._lock:
+                                self.hedge_wins += 1
+                        # 输掉的请求至少花了这么久，按删失样本记一次，否则慢后端的延迟永远不会更新
+                        now = time.perf_counter()
+                        for loser, _, started in running.values():
+                            self.record_censored(loser, now - started)
+                        return future.result()
+                    last_error = future.exception()
+                if queue and (not running or (self.hedge and time.monotonic() >= hedge_at)):
+                    if running:
+                        with self._lock:
+                            self.hedged += 1
+                    launch()
+            raise last_error
+        finally:
+            for future, (_, event, _) in running.items():
+                event.set()
+                if discard is not None:
+                    future.add_done_callback(
+                        lambda f: discard(f.result()) if not f.cancelled() and f.exception() is None else None
+                    )
+
+    def _timed(self, backend: str, attempt: Callable[[str, threading.Event], T], event: threading.Event) -> T:
+        start = time.perf_counter()
+        try:
+            result = attempt(backend, event)
+        except CancelledError:
+            raise
+        except Exception:
+            self.record(backend, None, False)
+            raise
+        if not event.is_set():
+            self.record(backend, time.perf_counter() - start, True)
+        return result
+
+    def status(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {
+                    "backend": backend,
+                    "latency": stats.latency,
+                    "p95": stats.p95(),
+                    "error_rate": stats.error_rate
+                }
+                for backend, stats in self.stats.items()
+            ]
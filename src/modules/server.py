@@ -0,0 +1,238 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import TimeoutError
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+try:
+    from aiohttp import WSMsgType, web
+except ImportError:  # 只有服务模式需要
+    web = None
+
+from src.modules.llm_client import BackendError
+
+
+def _error(status: int, message: str, error_type: str = "invalid_request_error") -> "web.Response":
+    return web.json_response({"error": {"message": message, "type": error_type}}, status=status)
+
+
+def _sse(data: Dict) -> bytes:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+class ChatServer:
+    """多会话服务：每个会话有独立的对话历史和人设，后端、知识库和线程池共享，长期记忆不开启；
+    提供OpenAI兼容的 /v1/chat/completions(支持stream)和 /v1/ws WebSocket接口。
+    会话历史保存在服务端，请求里只取最后一条用户消息"""
+
+    def __init__(self, bot, max_concurrency: int = 4, max_sessions: int = 1000, allow_execute: bool = False):
+        self.bot = bot
+        self.max_sessions = max_sessions
+        self.allow_execute = allow_execute
+        self.sessions: "OrderedDict[str, Tuple[object, asyncio.Lock]]" = OrderedDict()
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _new_session(self, session_id: str, persona: Optional[Dict]):
+        # 创建会话要从记忆库读历史摘要，放到线程池里做，不阻塞事件循环。
+        # 摘要按 "server:" 前缀区分，不会和终端对话(session_id为default)的摘要混在一起
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.bot.new_session, f"server:{session_id}", persona, self.allow_execute
+        )
+
+    async def _session(self, session_id: str, persona: Optional[Dict] = None) -> Tuple[object, asyncio.Lock]:
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            session = await self._new_session(session_id, persona)
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                entry = self.sessions[session_id] = (session, asyncio.Lock())
+                self._evict()
+                return entry
+            # 等待期间同一个会话已经被别的请求建好了
+            session.history.close()
+        self.sessions.move_to_end(session_id)
+        if persona and any(entry[0].persona.get(key) != value for key, value in persona.items()):
+            entry[0].update_persona(persona.get("name"), persona.get("traits"), persona.get("background"))
+        return entry
+
+    def _evict(self):
+        """会话数超过上限时淘汰最久没用、当前也没有请求的会话；历史摘要已经存进记忆库，下次会接着用"""
+        for session_id in list(self.sessions):
+            if len(self.sessions) <= self.max_sessions:
+                return
+            session, lock = self.sessions[session_id]
+            if not lock.locked():
+                del self.sessions[session_id]
+                session.history.close()
+
+    async def _run_turn(self, session, user_input: str) -> str:
+        handle = session.submit(user_input)
+        try:
+            return await asyncio.wrap_future(handle.future)
+        finally:
+            if not handle.done():
+                handle.cancel()
+
+    async def _stream_turn(self, session, user_input: str) -> AsyncIterator[str]:
+        """把后台线程里的流式回调转成异步迭代；客户端断开时取消请求"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        handle = session.submit(user_input, on_delta=lambda piece: loop.call_soon_threadsafe(queue.put_nowait, piece))
+        done = asyncio.wrap_future(handle.future)
+        done.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while True:
+                piece = await queue.get()
+                if piece is None:
+                    break
+                yield piece
+            await done
+        finally:
+            if not handle.done():
+                handle.cancel()
+
+    async def handle_chat(self, request: "web.Request") -> "web.StreamResponse":
+        try:
+            body = await request.json()
+        except ValueError:
+            return _error(400, "请求体不是有效的JSON")
+        user_input = next(
+            (message.get("content") for message in reversed(body.get("messages") or []) if message.get("role") == "user"),
+            None
+        )
+        if not isinstance(user_input, str) or not user_input.strip():
+            return _error(400, "缺少用户消息")
+        session_id = request.headers.get("X-Session-Id") or body.get("user")
+        if session_id:
+            session, lock = await self._session(session_id, body.get("persona"))
+        else:
+            # 没有会话标识的请求各自独立，用完即弃，不和别的请求共用历史
+            session, lock = await self._new_session(f"oneoff-{uuid.uuid4().hex}", body.get("persona")), asyncio.Lock()
+        try:
+            return await self._handle_chat(request, body, session, lock, user_input)
+        finally:
+            if not session_id:
+                session.history.close()
+
+    async def _handle_chat(self, request: "web.Request", body: Dict, session, lock: asyncio.Lock,
+                           user_input: str) -> "web.StreamResponse":
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = body.get("model") or "neuro-bot"
+
+        def chunk(delta: Dict, finish_reason: Optional[str] = None) -> bytes:
+            return _sse({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            })
+
+        # 同一会话的请求按顺序处理，先排会话锁再占并发名额
+        async with lock:
+            async with self.semaphore:
+                if not body.get("stream"):
+                    try:
+                        content = await asyncio.wait_for(self._run_turn(session, user_input), self.bot.request_timeout)
+                    except (asyncio.TimeoutError, TimeoutError):
+                        # 后台请求到了截止时间和这里等超时是同一件事
+                        return _error(504, f"请求超过{self.bot.request_timeout}秒没有完成", "timeout")
+                    except BackendError as e:
+                        return _error(502, str(e), "backend_error")
+                    except Exception as e:
+                        return _error(500, str(e), "server_error")
+                    return web.json_response({
+                        "id": completion_id,
+                        "object": "chat.completion",
+                        "created": created,
+                        "model": model,
+                        "choices": [{
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop"
+                        }]
+                    })
+
+                response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+                await response.prepare(request)
+                await response.write(chunk({"role": "assistant"}))
+                try:
+                    async for piece in self._stream_turn(session, user_input):
+                        await response.write(chunk({"content": piece}))
+                    await response.write(chunk({}, "stop"))
+                except BackendError as e:
+                    await response.write(_sse({"error": {"message": str(e), "type": "backend_error"}}))
+                except ConnectionResetError:
+                    return response  # 客户端已经断开
+                except Exception as e:
+                    await response.write(_sse({"error": {"message": str(e), "type": "server_error"}}))
+                await response.write(b"data: [DONE]\n\n")
+                await response.write_eof()
+                return response
+
+    async def handle_ws(self, request: "web.Request") -> "web.WebSocketResponse":
+        """收 {"content": ..., "session"?: ..., "persona"?: {...}}，
+        回 {"type": "delta"/"done"/"error", ...}；不指定session时整个连接是一个会话"""
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        default_session = request.query.get("session") or uuid.uuid4().hex
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            try:
+                data = json.loads(message.data)
+            except ValueError:
+                await ws.send_json({"type": "error", "message": "消息不是有效的JSON"})
+                continue
+            content = data.get("content")
+            if not isinstance(content, str) or not content.strip():
+                await ws.send_json({"type": "error", "message": "缺少content"})
+                continue
+            session, lock = await self._session(data.get("session") or default_session, data.get("persona"))
+            async with lock:
+                async with self.semaphore:
+                    pieces = []
+                    try:
+                        async for piece in self._stream_turn(session, content):
+                            pieces.append(piece)
+                            await ws.send_json({"type": "delta", "content": piece})
+                        await ws.send_json({"type": "done", "content": "".join(pieces)})
+                    except ConnectionResetError:
+                        break
+                    except Exception as e:
+                        await ws.send_json({"type": "error", "message": str(e)})
+        return ws
+
+    async def handle_models(self, request: "web.Request") -> "web.Response":
+        models = sorted({config.get("chat_model", "silica-chat") for config in self.bot.api_config.values()})
+        return web.json_response({"object": "list", "data": [{"id": model, "object": "model"} for model in models]})
+
+    def create_app(self) -> "web.Application":
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle_chat)
+        app.router.add_get("/v1/models", self.handle_models)
+        app.router.add_get("/v1/ws", self.handle_ws)
+        return app
+
+
+def run_server(bot, config: Dict):
+    """阻塞运行服务，直到Ctrl+C"""
+    if web is None:
+        raise ImportError("服务模式需要安装aiohttp: pip install aiohttp")
+
+    async def create_app() -> "web.Application":
+        # Semaphore和Lock要在服务的事件循环里创建
+        server = ChatServer(
+            bot,
+            max_concurrency=config.get("max_concurrency", 4),
+            max_sessions=config.get("max_sessions", 1000),
+            allow_execute=config.get("allow_execute", False)
+        )
+        return server.create_app()
+
+    host, port = config.get("host", "127.0.0.1"), config.get("port", 8000)
+    print(f"Neuro-bot服务已启动: http://{host}:{port}/v1/chat/completions, ws://{host}:{port}/v1/ws")
+    web.run_app(create_app(), host=host, port=port, print=None)
@@ -0,0 +1,854 @@
+import os
+import json
+import math
+import sqlite3
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from src.constants import MONGO_URI, MONGO_DB, MONGO_COLLECTION, SQLITE_PATH, MEMORY_RECALL_CANDIDATES, \
+    MEMORY_HALF_LIFE_DAYS, MEMORY_MIN_WEIGHT, MEMORY_TTL_GRACE
+from src.modules.chunker import tokenize, content_hash
+
+
+class KnowledgeStore:
+    """知识块存储接口，每条知识块是 {"id", "domain", "content", "hash"}，(domain, hash) 唯一"""
+
+    # 存储自带全文检索时KnowledgeSystem就不用在内存里维护BM25索引
+    supports_search = False
+
+    def new_id(self) -> str:
+        raise NotImplementedError
+
+    def insert_chunks(self, docs: List[Dict]) -> Tuple[List[int], Dict[int, str]]:
+        """批量无序写入，已存在的(domain, hash)跳过；返回(写入失败的下标, {已存在的下标: 已存在的id})"""
+        raise NotImplementedError
+
+    def delete_chunks(self, chunk_ids: List[str]):
+        raise NotImplementedError
+
+    def compact(self) -> Dict[str, str]:
+        """补全缺失的哈希并删除重复知识块，返回{被删除的id: 保留的id}"""
+        raise NotImplementedError
+
+    def delete_all(self) -> int:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def iter_chunks(self, domain: str = None, batch_size: int = 1000, with_ids: bool = False) -> Iterator[Dict]:
+        raise NotImplementedError
+
+    def get_chunks(self, chunk_ids: List[str]) -> Dict[str, Tuple[str, str]]:
+        raise NotImplementedError
+
+    def get_page(self, domain: str, page: int, page_size: int) -> List[str]:
+        raise NotImplementedError
+
+    def count_by_domain(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+    def search(self, query: str, top_k: int) -> List[Tuple[float, str, str, str]]:
+        """返回[(分数, id, 领域, 内容)]"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryStore:
+    """记忆与对话存储接口，记忆是 {"id", "content", "tags", "metadata", "created_at", "last_accessed", "base_weight",
+    "access_count"}，读取时另外带上现算的 weight 和 expires_at"""
+
+    def new_id(self) -> str:
+        raise NotImplementedError
+
+    def insert_memories(self, memories: List[Dict]) -> List[str]:
+        """批量写入记忆，记忆里带id时使用该id；id已存在的跳过，失败重试时不会重复写入"""
+        raise NotImplementedError
+
+    def find_memories(self, tags: List[str] = None, limit: int = 10) -> List[Dict]:
+        raise NotImplementedError
+
+    def recall_memories(self, tags: List[str], limit: int, now: datetime,
+                        candidates: int = MEMORY_RECALL_CANDIDATES) -> List[Dict]:
+        """按 标签重合数 × 当前权重 打分，一次查询返回未过期记忆中得分最高的limit条，结果带score字段；
+        没有标签时只在过期时间最晚的candidates条里排序"""
+        raise NotImplementedError
+
+    def bump_memories(self, bumps: Dict[str, Tuple[int, datetime]]):
+        """批量记录访问：{id: (访问次数, 最后访问时间)}，同时顺延expires_at"""
+        raise NotImplementedError
+
+    def purge_expired(self, now: datetime) -> List[List[str]]:
+        """删除已过期的记忆，返回被删除记忆的标签，用来同步标签统计"""
+        raise NotImplementedError
+
+    def iter_memories(self) -> Iterator[Dict]:
+        raise NotImplementedError
+
+    def load_tag_stats(self) -> Tuple[Dict[str, int], Dict[Tuple[str, str], int]]:
+        """读取标签计数和标签对(按字典序)共现计数"""
+        raise NotImplementedError
+
+    def update_tag_stats(self, counts: Dict[str, int], pairs: Dict[Tuple[str, str], int]):
+        """按增量更新标签统计，计数减到0的条目会被删除"""
+        raise NotImplementedError
+
+    def insert_conversations(self, conversations: List[Dict]) -> List[str]:
+        """和insert_memories一样，id已存在的跳过"""
+        raise NotImplementedError
+
+    def get_conversation(self, conversation_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def get_summary(self, session_id: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def save_summary(self, session_id: str, summary: str, now: datetime):
+        """每个会话只保存一份滚动摘要，新的覆盖旧的"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MongoKnowledgeStore(KnowledgeStore):
+    def __init__(self, uri: str = MONGO_URI, db_name: str = MONGO_DB, collection: str = MONGO_COLLECTION):
+        self.client = MongoClient(uri)
+        self.collection = self.client[db_name.lower()][collection.lower()]
+        self.collection.create_index([("domain", 1)])
+        self._ensure_hash_index()
+
+    def _ensure_hash_index(self):
+        # 去重前写入的旧数据没有hash字段，用部分索引跳过它们，/compact之后再补上
+        try:
+            self.collection.create_index(
+                [("domain", 1), ("hash", 1)], unique=True, name="domain_hash_unique",
+                partialFilterExpression={"hash": {"$exists": True}}
+            )
+        except OperationFailure as e:
+            print(f"创建知识去重索引失败，请执行 /compact 清理重复知识: {e}")
+
+    def new_id(self) -> str:
+        return str(ObjectId())
+
+    def insert_chunks(self, docs: List[Dict]) -> Tuple[List[int], Dict[int, str]]:
+        if not docs:
+            return [], {}
+        ops = [
+            UpdateOne(
+                {"domain": doc["domain"], "hash": doc["hash"]},
+                {"$setOnInsert": {"_id": ObjectId(doc["id"]), "content": doc["content"]}},
+                upsert=True
+            )
+            for doc in docs
+        ]
+        failed = []
+        try:
+            upserted = self.collection.bulk_write(ops, ordered=False).upserted_ids
+        except BulkWriteError as e:
+            failed = [error["index"] for error in e.details.get("writeErrors", [])]
+            upserted = {item["index"]: item["_id"] for item in e.details.get("upserted", [])}
+        skipped = [i for i in range(len(docs)) if i not in upserted and i not in set(failed)]
+        existing = {}
+        by_domain = {}
+        for i in skipped:
+            by_domain.setdefault(docs[i]["domain"], {})[docs[i]["hash"]] = i
+        for domain, hashes in by_domain.items():
+            for doc in self.collection.find({"domain": domain, "hash": {"$in": list(hashes)}}, {"_id": 1, "hash": 1}):
+                existing[hashes[doc["hash"]]] = str(doc["_id"])
+        return failed, existing
+
+    def delete_chunks(self, chunk_ids: List[str]):
+        for start in range(0, len(chunk_ids), 1000):
+            batch = [ObjectId(chunk_id) for chunk_id in chunk_ids[start:start + 1000]]
+            self.collection.delete_many({"_id": {"$in": batch}})
+
+    def compact(self) -> Dict[str, str]:
+        seen = {}
+        duplicates = {}
+        missing_hash = []
+        for doc in self.collection.find({}, {"domain": 1, "content": 1, "hash": 1}).sort("_id", 1):
+            digest = doc.get("hash") or content_hash(doc["content"])
+            key = (doc["domain"], digest)
+            if key in seen:
+                duplicates[str(doc["_id"])] = seen[key]
+            else:
+                seen[key] = str(doc["_id"])
+                if "hash" not in doc:
+                    missing_hash.append((doc["_id"], digest))
+        del seen
+        # 先删重复再补哈希，否则补上的哈希会撞唯一索引
+        self.delete_chunks(list(duplicates))
+        for start in range(0, len(missing_hash), 1000):
+            self.collection.bulk_write([
+                UpdateOne({"_id": doc_id}, {"$set": {"hash": digest}})
+                for doc_id, digest in missing_hash[start:start + 1000]
+            ], ordered=False)
+        self._ensure_hash_index()
+        return duplicates
+
+    def delete_all(self) -> int:
+        return self.collection.delete_many({}).deleted_count
+
+    def count(self) -> int:
+        return self.collection.estimated_document_count()
+
+    def iter_chunks(self, domain: str = None, batch_size: int = 1000, with_ids: bool = False) -> Iterator[Dict]:
+        projection = {"_id": 1 if with_ids else 0, "domain": 1, "content": 1}
+        cursor = self.collection.find({"domain": domain} if domain else {}, projection, batch_size=batch_size)
+        for doc in cursor:
+            chunk = {"domain": doc["domain"], "content": doc["content"]}
+            if with_ids:
+                chunk["id"] = str(doc["_id"])
+            yield chunk
+
+    def get_chunks(self, chunk_ids: List[str]) -> Dict[str, Tuple[str, str]]:
+        cursor = self.collection.find({"_id": {"$in": [ObjectId(chunk_id) for chunk_id in chunk_ids]}},
+                                      {"domain": 1, "content": 1})
+        return {str(doc["_id"]): (doc["domain"], doc["content"]) for doc in cursor}
+
+    def get_page(self, domain: str, page: int, page_size: int) -> List[str]:
+        cursor = self.collection.find({"domain": domain}, {"_id": 0, "content": 1}) \
+            .sort("_id", 1).skip(page * page_size).limit(page_size)
+        return [doc["content"] for doc in cursor]
+
+    def count_by_domain(self) -> Dict[str, int]:
+        pipeline = [
+            {"$group": {"_id": "$domain", "count": {"$sum": 1}}},
+            {"$sort": {"_id": 1}}
+        ]
+        return {doc["_id"]: doc["count"] for doc in self.collection.aggregate(pipeline)}
+
+    def close(self):
+        self.client.close()
+
+
+class MongoMemoryStore(MemoryStore):
+    def __init__(self, db_name: str = MONGO_DB, host: str = "localhost", port: int = 27017, uri: str = None):
+        self.client = MongoClient(uri) if uri else MongoClient(host, port)
+        self.db = self.client[db_name]
+        self.memories = self.db.memories
+        self.conversations = self.db.conversations
+        self.tag_counts = self.db.tag_counts
+        self.tag_pairs = self.db.tag_pairs
+        self.summaries = self.db.summaries
+        self._migrate_weights()
+        # 召回按标签过滤再按过期时间取候选；过期记忆平时由整理任务删除，TTL索引兜底
+        self.memories.create_index([("tags", 1), ("expires_at", -1)])
+        self.memories.create_index("expires_at", expireAfterSeconds=MEMORY_TTL_GRACE)
+
+    def _migrate_weights(self, batch_size: int = 1000):
+        """旧数据只存了weight，把它作为base_weight并补上expires_at"""
+        legacy = {"base_weight": {"$exists": False}}
+        ops = []
+        for doc in self.memories.find(legacy, {"weight": 1, "access_count": 1, "last_accessed": 1}):
+            base_weight = doc.get("weight", 1.0)
+            ops.append(UpdateOne({"_id": doc["_id"]}, {
+                "$set": {"base_weight": base_weight, "expires_at": doc["last_accessed"] + timedelta(
+                    seconds=memory_lifetime(base_weight, doc.get("access_count", 1)))},
+                "$unset": {"weight": ""}
+            }))
+            if len(ops) >= batch_size:
+                self.memories.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            self.memories.bulk_write(ops, ordered=False)
+
+    @staticmethod
+    def _from_doc(doc: Dict) -> Dict:
+        doc = dict(doc)
+        doc["id"] = str(doc.pop("_id"))
+        if "base_weight" in doc and "weight" not in doc:
+            idle = (datetime.utcnow() - doc["last_accessed"]).total_seconds()
+            doc["weight"] = memory_weight(doc["base_weight"], doc["access_count"], idle)
+        return doc
+
+    def new_id(self) -> str:
+        return str(ObjectId())
+
+    def _to_doc(self, item: Dict) -> Dict:
+        doc = {key: value for key, value in item.items() if key != "id"}
+        doc["_id"] = ObjectId(item["id"]) if "id" in item else ObjectId(self.new_id())
+        return doc
+
+    @staticmethod
+    def _insert_many(collection, docs: List[Dict]):
+        """无序批量插入，忽略重复_id：上次部分写入后整批重试时，已写入的会报重复键"""
+        try:
+            collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+    def insert_memories(self, memories: List[Dict]) -> List[str]:
+        if not memories:
+            return []
+        docs = [self._to_doc(memory) for memory in memories]
+        for doc in docs:
+            doc["expires_at"] = doc["last_accessed"] + timedelta(
+                seconds=memory_lifetime(doc["base_weight"], doc["access_count"]))
+        self._insert_many(self.memories, docs)
+        return [str(doc["_id"]) for doc in docs]
+
+    def find_memories(self, tags: List[str] = None, limit: int = 10) -> List[Dict]:
+        query = {"expires_at": {"$gt": datetime.utcnow()}}
+        if tags:
+            query["tags"] = {"$in": tags}
+        return [self._from_doc(doc) for doc in self.memories.find(query).limit(limit)]
+
+    @staticmethod
+    def _half_life_ms() -> Dict:
+        return {"$multiply": [MEMORY_HALF_LIFE_DAYS * 86400 * 1000.0,
+                              {"$add": [1, {"$log10": {"$max": ["$access_count", 1]}}]}]}
+
+    def recall_memories(self, tags: List[str], limit: int, now: datetime,
+                        candidates: int = MEMORY_RECALL_CANDIDATES) -> List[Dict]:
+        overlap = {"$size": {"$setIntersection": ["$tags", tags]}} if tags else 1
+        match = {"expires_at": {"$gt": now}}
+        if tags:
+            match["tags"] = {"$in": tags}
+        pipeline = [{"$match": match}]
+        if not tags:
+            # 和SQLite一致：有标签时给所有命中的记忆打分，只有没标签时才限制候选数
+            pipeline += [{"$sort": {"expires_at": -1}}, {"$limit": candidates}]
+        pipeline += [
+            {"$addFields": {"weight": {"$multiply": ["$base_weight", {"$pow": [
+                0.5, {"$divide": [{"$subtract": [now, "$last_accessed"]}, self._half_life_ms()]}
+            ]}]}}},
+            {"$addFields": {"score": {"$multiply": [overlap, "$weight"]}}},
+            {"$sort": {"score": -1}},
+            {"$limit": limit}
+        ]
+        return [self._from_doc(doc) for doc in self.memories.aggregate(pipeline)]
+
+    def bump_memories(self, bumps: Dict[str, Tuple[int, datetime]]):
+        if not bumps:
+            return
+        lifetime = {"$multiply": [self._half_life_ms(), {"$ln": {"$max": [
+            {"$divide": ["$base_weight", MEMORY_MIN_WEIGHT]}, 1
+        ]}}, 1 / math.log(2)]}
+        self.memories.bulk_write([
+            UpdateOne({"_id": ObjectId(memory_id)}, [
+                {"$set": {
+                    "access_count": {"$add": ["$access_count", count]},
+                    "last_accessed": {"$max": ["$last_accessed", last_accessed]}
+                }},
+                {"$set": {"expires_at": {"$add": ["$last_accessed", lifetime]}}}
+            ])
+            for memory_id, (count, last_accessed) in bumps.items()
+        ], ordered=False)
+
+    def purge_expired(self, now: datetime) -> List[List[str]]:
+        deleted_tags = []
+        ids = []
+        for doc in self.memories.find({"expires_at": {"$lt": now}}, {"tags": 1}):
+            ids.append(doc["_id"])
+            deleted_tags.append(doc.get("tags", []))
+        for start in range(0, len(ids), 1000):
+            self.memories.delete_many({"_id": {"$in": ids[start:start + 1000]}})
+        return deleted_tags
+
+    def iter_memories(self) -> Iterator[Dict]:
+        for doc in self.memories.find():
+            yield self._from_doc(doc)
+
+    def load_tag_stats(self) -> Tuple[Dict[str, int], Dict[Tuple[str, str], int]]:
+        counts = {doc["_id"]: doc["count"] for doc in self.tag_counts.find()}
+        pairs = {(doc["_id"]["a"], doc["_id"]["b"]): doc["count"] for doc in self.tag_pairs.find()}
+        return counts, pairs
+
+    def update_tag_stats(self, counts: Dict[str, int], pairs: Dict[Tuple[str, str], int]):
+        count_ops = [UpdateOne({"_id": tag}, {"$inc": {"count": delta}}, upsert=True)
+                     for tag, delta in counts.items() if delta]
+        pair_ops = [UpdateOne({"_id": {"a": a, "b": b}}, {"$inc": {"count": delta}}, upsert=True)
+                    for (a, b), delta in pairs.items() if delta]
+        if count_ops:
+            self.tag_counts.bulk_write(count_ops, ordered=False)
+        if pair_ops:
+            self.tag_pairs.bulk_write(pair_ops, ordered=False)
+        if any(delta < 0 for delta in counts.values()):
+            self.tag_counts.delete_many({"count": {"$lte": 0}})
+            self.tag_pairs.delete_many({"count": {"$lte": 0}})
+
+    def insert_conversations(self, conversations: List[Dict]) -> List[str]:
+        if not conversations:
+            return []
+        docs = [self._to_doc(conversation) for conversation in conversations]
+        self._insert_many(self.conversations, docs)
+        return [str(doc["_id"]) for doc in docs]
+
+    def get_conversation(self, conversation_id: str) -> Optional[Dict]:
+        doc = self.conversations.find_one({"_id": ObjectId(conversation_id)})
+        return self._from_doc(doc) if doc else None
+
+    def get_summary(self, session_id: str) -> Optional[str]:
+        doc = self.summaries.find_one({"_id": session_id})
+        return doc["summary"] if doc else None
+
+    def save_summary(self, session_id: str, summary: str, now: datetime):
+        self.summaries.update_one({"_id": session_id}, {"$set": {"summary": summary, "updated_at": now}}, upsert=True)
+
+    def close(self):
+        self.client.close()
+
+
+class _SQLiteBase:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # 后台线程(文件监视、记忆管理)和主线程共用一个连接，用锁串行化
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self._lock = threading.RLock()
+
+    def new_id(self) -> str:
+        return uuid.uuid4().hex
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class SQLiteKnowledgeStore(_SQLiteBase, KnowledgeStore):
+    """单机部署用的嵌入式存储，全文检索用FTS5，分词结果预先算好存进去以支持中文"""
+
+    supports_search = True
+
+    # 和内存BM25Index相同的参数
+    BM25_K1 = 1.5
+    BM25_B = 0.75
+    # tokens是空格连接的分词结果，空格数+1就是词数
+    _TOKEN_COUNT = "CASE WHEN tokens = '' THEN 0 ELSE LENGTH(tokens) - LENGTH(REPLACE(tokens, ' ', '')) + 1 END"
+
+    def __init__(self, path: str = SQLITE_PATH):
+        super().__init__(path)
+        self._fts_stats: Optional[Tuple[int, int]] = None  # (文档数, 总词数)，第一次检索时统计，之后随写入增减
+        with self._lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "rowid INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, domain TEXT NOT NULL, content TEXT NOT NULL)"
+            )
+            columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(chunks)")}
+            if "hash" not in columns:
+                # 去重前创建的库没有hash列，旧数据的hash为NULL，/compact时补上
+                self.conn.execute("ALTER TABLE chunks ADD COLUMN hash TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_domain ON chunks(domain)")
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_chunks_domain_hash ON chunks(domain, hash)")
+            self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(tokens)")
+
+    def _insert_one(self, doc: Dict) -> Optional[str]:
+        """写入一条知识块，已存在时返回已存在的id"""
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO chunks (id, domain, content, hash) VALUES (?, ?, ?, ?)",
+            (doc["id"], doc["domain"], doc["content"], doc["hash"])
+        )
+        if cursor.rowcount == 0:
+            row = self.conn.execute(
+                "SELECT id FROM chunks WHERE domain = ? AND hash = ?", (doc["domain"], doc["hash"])
+            ).fetchone()
+            return row["id"]
+        tokens = tokenize(doc["content"])
+        self.conn.execute("INSERT INTO chunks_fts (rowid, tokens) VALUES (?, ?)", (cursor.lastrowid, " ".join(tokens)))
+        if self._fts_stats is not None:
+            self._fts_stats = (self._fts_stats[0] + 1, self._fts_stats[1] + len(tokens))
+        return None
+
+    def insert_chunks(self, docs: List[Dict]) -> Tuple[List[int], Dict[int, str]]:
+        failed = []
+        existing = {}
+        with self._lock, self.conn:
+            for i, doc in enumerate(docs):
+                try:
+                    chunk_id = self._insert_one(doc)
+                    if chunk_id is not None:
+                        existing[i] = chunk_id
+                except sqlite3.DatabaseError:
+                    failed.append(i)
+        return failed, existing
+
+    def compact(self) -> Dict[str, str]:
+        seen = {}
+        duplicates = {}
+        missing_hash = []
+        with self._lock:
+            rows = self.conn.execute("SELECT rowid, id, domain, hash, content FROM chunks ORDER BY rowid")
+            for row in rows:
+                digest = row["hash"] or content_hash(row["content"])
+                key = (row["domain"], digest)
+                if key in seen:
+                    duplicates[row["id"]] = seen[key]
+                else:
+                    seen[key] = row["id"]
+                    if row["hash"] is None:
+                        missing_hash.append((digest, row["rowid"]))
+        del seen
+        # 先删重复再补哈希，否则补上的哈希会撞唯一索引
+        self.delete_chunks(list(duplicates))
+        with self._lock, self.conn:
+            self.conn.executemany("UPDATE chunks SET hash = ? WHERE rowid = ?", missing_hash)
+        return duplicates
+
+    def delete_chunks(self, chunk_ids: List[str]):
+        if not chunk_ids:
+            return
+        with self._lock, self.conn:
+            for start in range(0, len(chunk_ids), 500):
+                batch = chunk_ids[start:start + 500]
+                marks = ",".join("?" * len(batch))
+                rowids = f"SELECT rowid FROM chunks WHERE id IN ({marks})"
+                if self._fts_stats is not None:
+                    count, length = self.conn.execute(
+                        f"SELECT COUNT(*), SUM({self._TOKEN_COUNT}) FROM chunks_fts WHERE rowid IN ({rowids})", batch
+                    ).fetchone()
+                    self._fts_stats = (self._fts_stats[0] - count, self._fts_stats[1] - (length or 0))
+                self.conn.execute(f"DELETE FROM chunks_fts WHERE rowid IN ({rowids})", batch)
+                self.conn.execute(f"DELETE FROM chunks WHERE id IN ({marks})", batch)
+
+    def delete_all(self) -> int:
+        with self._lock, self.conn:
+            count = self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+            self.conn.execute("DELETE FROM chunks")
+            self.conn.execute("DELETE FROM chunks_fts")
+            self._fts_stats = (0, 0)
+        return count
+
+    def count(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def iter_chunks(self, domain: str = None, batch_size: int = 1000, with_ids: bool = False) -> Iterator[Dict]:
+        last_rowid = 0
+        while True:
+            with self._lock:
+                if domain:
+                    rows = self.conn.execute(
+                        "SELECT rowid, id, domain, content FROM chunks WHERE domain = ? AND rowid > ? "
+                        "ORDER BY rowid LIMIT ?", (domain, last_rowid, batch_size)
+                    ).fetchall()
+                else:
+                    rows = self.conn.execute(
+                        "SELECT rowid, id, domain, content FROM chunks WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                        (last_rowid, batch_size)
+                    ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                chunk = {"domain": row["domain"], "content": row["content"]}
+                if with_ids:
+                    chunk["id"] = row["id"]
+                yield chunk
+            last_rowid = rows[-1]["rowid"]
+
+    def get_chunks(self, chunk_ids: List[str]) -> Dict[str, Tuple[str, str]]:
+        if not chunk_ids:
+            return {}
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT id, domain, content FROM chunks WHERE id IN ({','.join('?' * len(chunk_ids))})", chunk_ids
+            ).fetchall()
+        return {row["id"]: (row["domain"], row["content"]) for row in rows}
+
+    def get_page(self, domain: str, page: int, page_size: int) -> List[str]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT content FROM chunks WHERE domain = ? ORDER BY rowid LIMIT ? OFFSET ?",
+                (domain, page_size, page * page_size)
+            ).fetchall()
+        return [row["content"] for row in rows]
+
+    def count_by_domain(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self.conn.execute("SELECT domain, COUNT(*) FROM chunks GROUP BY domain ORDER BY domain").fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def _stats(self) -> Tuple[int, float]:
+        """返回(文档数, 平均长度)，调用时需持有锁"""
+        if self._fts_stats is None:
+            row = self.conn.execute(f"SELECT COUNT(*), SUM({self._TOKEN_COUNT}) FROM chunks_fts").fetchone()
+            self._fts_stats = (row[0], row[1] or 0)
+        count, length = self._fts_stats
+        return count, length / count if count > 0 else 0.0
+
+    def search(self, query: str, top_k: int) -> List[Tuple[float, str, str, str]]:
+        """FTS5负责召回候选，分数按内存BM25Index的公式重算。
+        FTS5的bm25()在词出现于一半以上的文档时idf会被截成1e-6，小库里分数整体只有1e-6量级，
+        和min_score不在一个尺度上"""
+        terms = {term: '"{}"'.format(term.replace('"', '""')) for term in set(tokenize(query))}
+        if not terms or top_k <= 0:
+            return []
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT chunks_fts.tokens, chunks.id, chunks.domain, chunks.content "
+                "FROM chunks_fts JOIN chunks ON chunks.rowid = chunks_fts.rowid "
+                "WHERE chunks_fts MATCH ? ORDER BY bm25(chunks_fts) LIMIT ?",
+                (" OR ".join(terms.values()), top_k * 4)
+            ).fetchall()
+            if not rows:
+                return []
+            n, avg_len = self._stats()
+            df = {
+                term: self.conn.execute("SELECT COUNT(*) FROM chunks_fts WHERE chunks_fts MATCH ?", (match,)).fetchone()[0]
+                for term, match in terms.items()
+            }
+        avg_len = avg_len or 1.0
+        hits = []
+        for row in rows:
+            tokens = row["tokens"].split()
+            counts = Counter(tokens)
+            norm = self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * len(tokens) / avg_len)
+            score = 0.0
+            for term, freq in df.items():
+                tf = counts.get(term, 0)
+                if tf and freq:
+                    idf = math.log(1 + (n - freq + 0.5) / (freq + 0.5))
+                    score += idf * tf * (self.BM25_K1 + 1) / (tf + norm)
+            hits.append((score, row["id"], row["domain"], row["content"]))
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        return hits[:top_k]
+
+
+def _to_ts(value: datetime) -> float:
+    return value.timestamp()
+
+
+def _from_ts(value: float) -> datetime:
+    return datetime.fromtimestamp(value)
+
+
+def memory_half_life(access_count: int) -> float:
+    """记忆权重的半衰期(天)，访问次数越多衰减越慢"""
+    return MEMORY_HALF_LIFE_DAYS * (1 + math.log10(max(access_count, 1)))
+
+
+def memory_weight(base_weight: float, access_count: int, idle_seconds: float) -> float:
+    """闭式衰减：当前权重 = base_weight × 0.5^(闲置天数/半衰期)，读取时现算，不需要定期回写"""
+    return base_weight * 0.5 ** (max(idle_seconds, 0.0) / 86400 / memory_half_life(access_count))
+
+
+def memory_lifetime(base_weight: float, access_count: int) -> float:
+    """从最后一次访问起，权重衰减到MEMORY_MIN_WEIGHT需要的秒数，用来计算expires_at"""
+    if base_weight <= MEMORY_MIN_WEIGHT:
+        return 0.0
+    return memory_half_life(access_count) * 86400 * math.log2(base_weight / MEMORY_MIN_WEIGHT)
+
+
+class SQLiteMemoryStore(_SQLiteBase, MemoryStore):
+    def __init__(self, path: str = SQLITE_PATH):
+        super().__init__(path)
+        with self._lock, self.conn:
+            self.conn.create_function("memory_lifetime", 2, memory_lifetime, deterministic=True)
+            self.conn.create_function(
+                "memory_weight", 4, lambda base_weight, access_count, last_accessed, now:
+                memory_weight(base_weight, access_count, now - last_accessed), deterministic=True
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS memories ("
+                "id TEXT PRIMARY KEY, content TEXT NOT NULL, tags TEXT NOT NULL, metadata TEXT NOT NULL, "
+                "tag_weights TEXT NOT NULL DEFAULT '{}', created_at REAL NOT NULL, last_accessed REAL NOT NULL, "
+                "base_weight REAL NOT NULL, access_count INTEGER NOT NULL, expires_at REAL NOT NULL)"
+            )
+            columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(memories)")}
+            if "base_weight" not in columns:
+                # 旧库的weight由定期任务回写，现在改为读取时按base_weight现算
+                self.conn.execute("DROP INDEX IF EXISTS idx_memories_weight")
+                self.conn.execute("ALTER TABLE memories RENAME COLUMN weight TO base_weight")
+                self.conn.execute("ALTER TABLE memories ADD COLUMN expires_at REAL NOT NULL DEFAULT 0")
+                self.conn.execute("UPDATE memories SET expires_at = last_accessed + memory_lifetime(base_weight, access_count)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS memory_tags ("
+                "memory_id TEXT NOT NULL REFERENCES memories(id) ON DELETE CASCADE, tag TEXT NOT NULL, "
+                "PRIMARY KEY (tag, memory_id))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_memories_expires ON memories (expires_at)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS tag_counts (tag TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS tag_pairs ("
+                "tag_a TEXT NOT NULL, tag_b TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (tag_a, tag_b))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "id TEXT PRIMARY KEY, messages TEXT NOT NULL, metadata TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS summaries (session_id TEXT PRIMARY KEY, summary TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    @staticmethod
+    def _from_row(row: sqlite3.Row) -> Dict:
+        memory = {
+            "id": row["id"],
+            "content": row["content"],
+            "tags": json.loads(row["tags"]),
+            "metadata": json.loads(row["metadata"]),
+            "tag_weights": json.loads(row["tag_weights"]),
+            "created_at": _from_ts(row["created_at"]),
+            "last_accessed": _from_ts(row["last_accessed"]),
+            "base_weight": row["base_weight"],
+            "weight": row["weight"] if "weight" in row.keys() else memory_weight(
+                row["base_weight"], row["access_count"], _to_ts(datetime.utcnow()) - row["last_accessed"]),
+            "access_count": row["access_count"],
+            "expires_at": _from_ts(row["expires_at"])
+        }
+        if "score" in row.keys():
+            memory["score"] = row["score"]
+        return memory
+
+    def insert_memories(self, memories: List[Dict]) -> List[str]:
+        memory_ids = [memory.get("id") or self.new_id() for memory in memories]
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO memories (id, content, tags, metadata, created_at, last_accessed, base_weight, access_count, "
+                "expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(memory_id, memory["content"], json.dumps(memory["tags"], ensure_ascii=False),
+                  json.dumps(memory["metadata"], ensure_ascii=False, default=str), _to_ts(memory["created_at"]),
+                  _to_ts(memory["last_accessed"]), memory["base_weight"], memory["access_count"],
+                  _to_ts(memory["last_accessed"]) + memory_lifetime(memory["base_weight"], memory["access_count"]))
+                 for memory_id, memory in zip(memory_ids, memories)]
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO memory_tags (memory_id, tag) VALUES (?, ?)",
+                [(memory_id, tag) for memory_id, memory in zip(memory_ids, memories) for tag in memory["tags"]]
+            )
+        return memory_ids
+
+    def find_memories(self, tags: List[str] = None, limit: int = 10) -> List[Dict]:
+        now = _to_ts(datetime.utcnow())
+        with self._lock:
+            if tags:
+                rows = self.conn.execute(
+                    f"SELECT * FROM memories WHERE expires_at > ? AND id IN (SELECT memory_id FROM memory_tags "
+                    f"WHERE tag IN ({','.join('?' * len(tags))})) LIMIT ?", (now, *tags, limit)
+                ).fetchall()
+            else:
+                rows = self.conn.execute("SELECT * FROM memories WHERE expires_at > ? LIMIT ?", (now, limit)).fetchall()
+        return [self._from_row(row) for row in rows]
+
+    def recall_memories(self, tags: List[str], limit: int, now: datetime,
+                        candidates: int = MEMORY_RECALL_CANDIDATES) -> List[Dict]:
+        weight = "memory_weight(m.base_weight, m.access_count, m.last_accessed, ?)"
+        now = _to_ts(now)
+        with self._lock:
+            if tags:
+                # 只扫(tag, memory_id)主键索引统计重合数，再回表取命中的记忆
+                rows = self.conn.execute(
+                    f"SELECT m.*, {weight} AS weight, c.overlap * {weight} AS score FROM ("
+                    f"SELECT memory_id, COUNT(*) AS overlap FROM memory_tags "
+                    f"WHERE tag IN ({','.join('?' * len(tags))}) GROUP BY memory_id) c "
+                    f"JOIN memories m ON m.id = c.memory_id WHERE m.expires_at > ? ORDER BY score DESC LIMIT ?",
+                    (now, now, *tags, now, limit)
+                ).fetchall()
+            else:
+                rows = self.conn.execute(
+                    f"SELECT m.*, {weight} AS weight, {weight} AS score FROM ("
+                    f"SELECT * FROM memories WHERE expires_at > ? ORDER BY expires_at DESC LIMIT ?) m "
+                    f"ORDER BY score DESC LIMIT ?",
+                    (now, now, now, candidates, limit)
+                ).fetchall()
+        return [self._from_row(row) for row in rows]
+
+    def bump_memories(self, bumps: Dict[str, Tuple[int, datetime]]):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "UPDATE memories SET last_accessed = MAX(last_accessed, :last), access_count = access_count + :count, "
+                "expires_at = MAX(last_accessed, :last) + memory_lifetime(base_weight, access_count + :count) "
+                "WHERE id = :id",
+                [{"last": _to_ts(last_accessed), "count": count, "id": memory_id}
+                 for memory_id, (count, last_accessed) in bumps.items()]
+            )
+
+    def purge_expired(self, now: datetime) -> List[List[str]]:
+        with self._lock, self.conn:
+            rows = self.conn.execute("SELECT tags FROM memories WHERE expires_at < ?", (_to_ts(now),)).fetchall()
+            self.conn.execute("DELETE FROM memories WHERE expires_at < ?", (_to_ts(now),))
+        return [json.loads(row["tags"]) for row in rows]
+
+    def iter_memories(self) -> Iterator[Dict]:
+        with self._lock:
+            rows = self.conn.execute("SELECT * FROM memories").fetchall()
+        for row in rows:
+            yield self._from_row(row)
+
+    def load_tag_stats(self) -> Tuple[Dict[str, int], Dict[Tuple[str, str], int]]:
+        with self._lock:
+            counts = {row[0]: row[1] for row in self.conn.execute("SELECT tag, count FROM tag_counts")}
+            pairs = {(row[0], row[1]): row[2] for row in self.conn.execute("SELECT tag_a, tag_b, count FROM tag_pairs")}
+        return counts, pairs
+
+    def update_tag_stats(self, counts: Dict[str, int], pairs: Dict[Tuple[str, str], int]):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO tag_counts (tag, count) VALUES (?, ?) "
+                "ON CONFLICT(tag) DO UPDATE SET count = count + excluded.count",
+                [(tag, delta) for tag, delta in counts.items() if delta]
+            )
+            self.conn.executemany(
+                "INSERT INTO tag_pairs (tag_a, tag_b, count) VALUES (?, ?, ?) "
+                "ON CONFLICT(tag_a, tag_b) DO UPDATE SET count = count + excluded.count",
+                [(a, b, delta) for (a, b), delta in pairs.items() if delta]
+            )
+            if any(delta < 0 for delta in counts.values()):
+                self.conn.execute("DELETE FROM tag_counts WHERE count <= 0")
+                self.conn.execute("DELETE FROM tag_pairs WHERE count <= 0")
+
+    def insert_conversations(self, conversations: List[Dict]) -> List[str]:
+        conversation_ids = [conversation.get("id") or self.new_id() for conversation in conversations]
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO conversations (id, messages, metadata, created_at) VALUES (?, ?, ?, ?)",
+                [(conversation_id, json.dumps(conversation["messages"], ensure_ascii=False),
+                  json.dumps(conversation["metadata"], ensure_ascii=False, default=str),
+                  _to_ts(conversation["created_at"]))
+                 for conversation_id, conversation in zip(conversation_ids, conversations)]
+            )
+        return conversation_ids
+
+    def get_conversation(self, conversation_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        if not row:
+            return None
+        return {
+            "id": row["id"],
+            "messages": json.loads(row["messages"]),
+            "metadata": json.loads(row["metadata"]),
+            "created_at": _from_ts(row["created_at"])
+        }
+
+    def get_summary(self, session_id: str) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute("SELECT summary FROM summaries WHERE session_id = ?", (session_id,)).fetchone()
+        return row["summary"] if row else None
+
+    def save_summary(self, session_id: str, summary: str, now: datetime):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO summaries (session_id, summary, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET summary = excluded.summary, updated_at = excluded.updated_at",
+                (session_id, summary, _to_ts(now))
+            )
+
+
+def create_knowledge_store(config: Dict = None) -> KnowledgeStore:
+    """根据config.json里的storage配置创建知识库存储"""
+    config = config or {}
+    if config.get("backend", "mongo") == "sqlite":
+        return SQLiteKnowledgeStore(config.get("sqlite_path", SQLITE_PATH))
+    return MongoKnowledgeStore(config.get("mongo_uri", MONGO_URI))
+
+
+def create_memory_store(config: Dict = None) -> MemoryStore:
+    config = config or {}
+    if config.get("backend", "mongo") == "sqlite":
+        return SQLiteMemoryStore(config.get("sqlite_path", SQLITE_PATH))
+    return MongoMemoryStore(uri=config.get("mongo_uri", MONGO_URI))
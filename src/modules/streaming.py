@@ -0,0 +1,49 @@
+from typing import List, Tuple
+
+EXECUTE_OPEN = "<execute>"
+EXECUTE_CLOSE = "</execute>"
+
+
+def _partial_tag_length(text: str, tag: str) -> int:
+    """text结尾有多少个字符可能是tag的开头，这部分要留到下个分片再判断"""
+    for length in range(min(len(text), len(tag) - 1), 0, -1):
+        if tag.startswith(text[-length:]):
+            return length
+    return 0
+
+
+class ExecuteStreamParser:
+    """增量解析流式回复里的<execute>...</execute>块：普通文字尽快吐出去，块一闭合就交给调用方执行，
+    标签被拆到两个分片里也能识别；没有闭合的块和原来一样直接丢弃"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.in_block = False
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        """返回 [("text", 文字) 或 ("execute", 命令)]"""
+        self.buffer += text
+        events = []
+        while True:
+            tag = EXECUTE_CLOSE if self.in_block else EXECUTE_OPEN
+            pos = self.buffer.find(tag)
+            if pos == -1:
+                if not self.in_block:
+                    keep = _partial_tag_length(self.buffer, tag)
+                    ready = self.buffer[:len(self.buffer) - keep]
+                    if ready:
+                        events.append(("text", ready))
+                    self.buffer = self.buffer[len(ready):]
+                return events
+            if self.in_block:
+                events.append(("execute", self.buffer[:pos].strip()))
+            elif pos:
+                events.append(("text", self.buffer[:pos]))
+            self.buffer = self.buffer[pos + len(tag):]
+            self.in_block = not self.in_block
+
+    def close(self) -> List[Tuple[str, str]]:
+        events = [("text", self.buffer)] if self.buffer and not self.in_block else []
+        self.buffer = ""
+        self.in_block = False
+        return events
@@ -0,0 +1,176 @@
+import os
+import zlib
+import threading
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+from src.modules.chunker import tokenize
+
+
+def _features(text: str) -> Counter:
+    """词/单字特征加上字符二元、三元组，对错别字和没分词的中文都比较稳"""
+    features = Counter(tokenize(text))
+    compact = "".join(text.lower().split())
+    for n in (2, 3):
+        features.update(f"#{compact[i:i + n]}" for i in range(len(compact) - n + 1))
+    return features
+
+
+class HashedVectorizer:
+    """把文本哈希到固定维度的稀疏TF向量，不需要词表，也不需要GPU和网络"""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    def buckets(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        features = _features(text)
+        index = np.empty(len(features), dtype=np.int64)
+        values = np.empty(len(features), dtype=np.float32)
+        for i, (feature, tf) in enumerate(features.items()):
+            h = zlib.crc32(feature.encode("utf-8"))
+            index[i] = h % self.dim
+            # 最高位决定符号，减少哈希冲突带来的偏差
+            values[i] = (1.0 + np.log(tf)) * (1.0 if h & 0x80000000 else -1.0)
+        return index, values
+
+    def transform(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        index, values = self.buckets(text)
+        np.add.at(vector, index, values)
+        return vector
+
+
+class VectorIndex:
+    """存放在内存映射文件里的float32向量矩阵，行号和知识块id一一对应"""
+
+    def __init__(self, directory: str, dim: int = 512):
+        self.directory = directory
+        self.dim = dim
+        self.vectorizer = HashedVectorizer(dim)
+        self.matrix_path = os.path.join(directory, "vectors.f32")
+        self.ids_path = os.path.join(directory, "vectors.ids")
+        self.df_path = os.path.join(directory, "vectors.df.npy")
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        self.ids: List[str] = []
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, "r", encoding="utf-8") as f:
+                self.ids = [line.rstrip("\n") for line in f]
+        rows = os.path.getsize(self.matrix_path) // (self.dim * 4) if os.path.exists(self.matrix_path) else 0
+        if rows != len(self.ids) or (os.path.exists(self.df_path) and np.load(self.df_path).shape != (self.dim,)):
+            # 文件不完整或者维度变了，只能丢掉重建
+            self.ids = []
+            rows = 0
+            for path in (self.matrix_path, self.ids_path, self.df_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.df = np.load(self.df_path) if os.path.exists(self.df_path) else np.zeros(self.dim, dtype=np.float64)
+        self.positions = {chunk_id: row for row, chunk_id in enumerate(self.ids) if chunk_id}
+        self._map(rows)
+
+    def _map(self, rows: int):
+        self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else \
+            np.zeros((0, self.dim), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def _save_meta(self, rewrite_ids: bool, new_ids: Iterable[str] = ()):
+        if rewrite_ids:
+            tmp_path = self.ids_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(f"{chunk_id}\n" for chunk_id in self.ids)
+            os.replace(tmp_path, self.ids_path)
+        else:
+            with open(self.ids_path, "a", encoding="utf-8") as f:
+                f.writelines(f"{chunk_id}\n" for chunk_id in new_ids)
+        np.save(self.df_path, self.df)
+
+    def add(self, chunk_ids: List[str], contents: List[str]):
+        """追加新的知识块向量，只写新增的行"""
+        if not chunk_ids:
+            return
+        with self._lock:
+            rows = np.zeros((len(chunk_ids), self.dim), dtype=np.float32)
+            for row, content in zip(rows, contents):
+                index, values = self.vectorizer.buckets(content)
+                np.add.at(row, index, values)
+                self.df[np.unique(index)] += 1
+            norms = np.linalg.norm(rows, axis=1, keepdims=True)
+            rows /= np.maximum(norms, 1e-12)
+
+            start = len(self.ids)
+            self.matrix = None
+            with open(self.matrix_path, "ab") as f:
+                f.write(rows.tobytes())
+            for offset, chunk_id in enumerate(chunk_ids):
+                self.positions[chunk_id] = start + offset
+            self.ids.extend(chunk_ids)
+            self._save_meta(False, chunk_ids)
+            self._map(len(self.ids))
+
+    def remove(self, chunk_ids: Iterable[str]):
+        """删除的行只清零打标记，墓碑太多时再整体压缩"""
+        with self._lock:
+            rows = [self.positions.pop(chunk_id) for chunk_id in chunk_ids if chunk_id in self.positions]
+            if not rows:
+                return
+            self.matrix = None
+            matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+", shape=(len(self.ids), self.dim))
+            for row in rows:
+                self.df[matrix[row] != 0] -= 1
+                matrix[row] = 0
+                self.ids[row] = ""
+            matrix.flush()
+            del matrix
+            np.maximum(self.df, 0, out=self.df)
+            if len(self.positions) < len(self.ids) // 2:
+                self._compact()
+            else:
+                self._save_meta(True)
+                self._map(len(self.ids))
+
+    def _compact(self):
+        keep = [row for row, chunk_id in enumerate(self.ids) if chunk_id]
+        old = np.memmap(self.matrix_path, dtype=np.float32, mode="r", shape=(len(self.ids), self.dim))
+        tmp_path = self.matrix_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for start in range(0, len(keep), 4096):
+                f.write(np.ascontiguousarray(old[keep[start:start + 4096]]).tobytes())
+        del old
+        os.replace(tmp_path, self.matrix_path)
+        self.ids = [self.ids[row] for row in keep]
+        self.positions = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        self._save_meta(True)
+        self._map(len(self.ids))
+
+    def clear(self):
+        with self._lock:
+            self.matrix = None
+            for path in (self.matrix_path, self.ids_path, self.df_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._load()
+
+    def search(self, query: str, top_k: int = 5, min_score: float = 0.0) -> List[Tuple[float, str]]:
+        """余弦相似度top-k，查询向量按IDF加权"""
+        with self._lock:
+            matrix, ids = self.matrix, self.ids
+            n = len(self.positions)
+            if not n or top_k <= 0:
+                return []
+            query_vector = self.vectorizer.transform(query)
+            query_vector *= np.log((1 + n) / (1 + self.df)).astype(np.float32) + 1.0
+        norm = np.linalg.norm(query_vector)
+        if norm == 0:
+            return []
+        scores = matrix @ (query_vector / norm)
+        k = min(top_k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[row]), ids[row]) for row in best if ids[row] and scores[row] > min_score]